@@ -20,148 +20,46 @@ bl_info = {
     "support": 'COMMUNITY',
     "category": "Import-Export"}
 
-import bpy
-import io_scene_pkg.variant_ui as variant_ui
-import io_scene_pkg.angel_scenedata as angel_scenedata
-import io_scene_pkg.bl_preferences as bl_preferences
-import io_scene_pkg.import_tex as import_tex
-import io_scene_pkg.material_helper_ui as material_helper_ui
+try:
+    import bpy
+except ImportError:
+    # running outside of Blender, only the bpy independent
+    # modules (pkg_file, shader_set, fvf, binary_helper) can be used
+    bpy = None
+
+if bpy is not None:
+    import io_scene_pkg.variant_ui as variant_ui
+    import io_scene_pkg.angel_scenedata as angel_scenedata
+    import io_scene_pkg.bl_preferences as bl_preferences
+    import io_scene_pkg.import_tex as import_tex
+    import io_scene_pkg.material_helper_ui as material_helper_ui
+    import io_scene_pkg.pkg_operators as pkg_operators
 
 
-from bpy.props import (
-        BoolProperty,
-        EnumProperty,
-        FloatProperty,
-        StringProperty,
-        CollectionProperty,
-        IntProperty,
-        PointerProperty
-        )
-from bpy_extras.io_utils import (
-        ImportHelper,
-        ExportHelper,
-        )
-
-class ImportPKG(bpy.types.Operator, ImportHelper):
-    """Import from PKG file format (.pkg)"""
-    bl_idname = "import_scene.pkg"
-    bl_label = 'Import PKG'
-    bl_options = {'UNDO'}
-
-    filename_ext = ".pkg"
-    filter_glob: StringProperty(default="*.pkg", options={'HIDDEN'})
-
-    import_variants: BoolProperty(
-        name="Import Variants",
-        description="Import variants from this file. Will clear existing variant data in the scene.",
-        default=True,
-        )
-        
-    def execute(self, context):
-        from . import import_pkg
-        keywords = self.as_keywords(ignore=("axis_forward",
-                                            "axis_up",
-                                            "filter_glob",
-                                            "check_existing",
-                                            ))
-
-        return import_pkg.load(self, context, **keywords)
-
-
-class ExportPKG(bpy.types.Operator, ExportHelper):
-    """Export to PKG file format (.PKG)"""
-    bl_idname = "export_scene.pkg"
-    bl_label = 'Export PKG'
-
-    filename_ext = ".pkg"
-    filter_glob: StringProperty(
-            default="*.pkg",
-            options={'HIDDEN'},
-            )
-
-    e_vertexcolors: BoolProperty(
-        name="Vertex Colors (Diffuse)",
-        description="Export vertex colors that affect diffuse",
-        default=False,
-        )
-        
-    e_vertexcolors_s: BoolProperty(
-        name="Vertex Colors (Specular)",
-        description="Export vertex colors that affect specular",
-        default=False,
-        )
-        
-    apply_modifiers: BoolProperty(
-        name="Apply Modifiers",
-        description="Do you desire modifiers to be applied in the PKG?",
-        default=True,
-        )
-        
-    selection_only: BoolProperty(
-        name="Selection Only",
-        description="Export only selected elements",
-        default=False,
-        )
-        
-    def execute(self, context):
-        from . import export_pkg
-        
-        keywords = self.as_keywords(ignore=("axis_forward",
-                                            "axis_up",
-                                            "filter_glob",
-                                            "check_existing",
-                                            ))
-                                    
-        return export_pkg.save(self, context, **keywords)
-
-
-# Add to a menu
-def menu_func_export(self, context):
-    self.layout.operator(ExportPKG.bl_idname, text="Angel Studios ModPackage (.pkg)")
-
-
-def menu_func_import(self, context):
-    self.layout.operator(ImportPKG.bl_idname, text="Angel Studios ModPackage (.pkg)")
-
-# Register factories
-classes = (
-    ImportPKG,
-    ExportPKG
-)
-
 def register():
     bl_preferences.register()
-    for cls in classes:
-        bpy.utils.register_class(cls)
+    pkg_operators.register()
     angel_scenedata.register()
     variant_ui.register()
     import_tex.register()
     material_helper_ui.register()
     
-    bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
-    bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
-    
     bpy.types.Material.variant = bpy.props.IntProperty(name="Variant")
     bpy.types.Material.cloned_from = bpy.props.PointerProperty(name="Cloned From", type=bpy.types.Material)
     
-    bpy.types.Scene.angel = PointerProperty(type=angel_scenedata.AngelSceneData)
+    bpy.types.Scene.angel = bpy.props.PointerProperty(type=angel_scenedata.AngelSceneData)
 
 
 def unregister():
     del bpy.types.Scene.angel
     del bpy.types.Material.cloned_from
     del bpy.types.Material.variant 
-    
-    bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
-    bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
 
     material_helper_ui.unregister()
     import_tex.unregister()
     variant_ui.unregister()
     angel_scenedata.unregister()
-    
-    for cls in reversed(classes):
-        bpy.utils.unregister_class(cls)
+    pkg_operators.unregister()
     bl_preferences.unregister()
     
 
@@ -7,25 +7,278 @@
 #
 # ##### END LICENSE BLOCK #####
 
+from collections import OrderedDict
+
 import bpy
 from bpy.props import (
         CollectionProperty,
+        BoolProperty,
+        FloatProperty,
+        FloatVectorProperty,
         IntProperty,
-        PointerProperty
+        PointerProperty,
+        StringProperty
         )
 
 from bpy.types import (
+        Image,
         Material,
         PropertyGroup
         )
+from bpy.app.handlers import persistent
+
+from io_scene_pkg.shader_set import Shader
+import io_scene_pkg.common_helpers as helper
+import io_scene_pkg.export_helper as export_helper
+import io_scene_pkg.import_helper as import_helper
+        
+        
+def get_base_material(material):
+    return material.cloned_from if material.cloned_from is not None else material
+    
+    
+class VariantIndex:
+    """the mesh material slots using each base material, so switching variants
+       only has to touch the slots whose material changes. slots are validated 
+       lazily when they change, added meshes are caught by the mesh count"""
+    def __init__(self):
+        self.slots = None
+        self.num_meshes = 0
+        
+        # base material -> material currently on its slots, None when unknown
+        self.applied = None
+        
+    def rebuild(self):
+        self.slots = {}
+        for mesh in bpy.data.meshes:
+            for slot_index, material in enumerate(mesh.materials):
+                if material is not None:
+                    self.slots.setdefault(get_base_material(material), []).append((mesh, slot_index))
+        self.num_meshes = len(bpy.data.meshes)
+        self.applied = None
+        
+    def apply(self, material_map):
+        """put the materials of a base material -> variant material map on the scene, 
+           base materials for everything not in the map"""
+        if self.slots is None or self.num_meshes != len(bpy.data.meshes):
+            self.rebuild()
+            
+        if self.applied is None:
+            changed_bases = list(self.slots.keys())
+        else:
+            changed_bases = [base for base in self.slots if material_map.get(base) != self.applied.get(base)]
+            
+        for base in changed_bases:
+            target = material_map.get(base, base)
+            for mesh, slot_index in self.slots[base]:
+                try:
+                    material = mesh.materials[slot_index]
+                except (ReferenceError, IndexError):
+                    # the mesh was removed, or lost slots
+                    material = None
+                if material is None or get_base_material(material) != base:
+                    # material slots were edited since the index was built
+                    self.rebuild()
+                    return self.apply(material_map)
+                if material != target:
+                    mesh.materials[slot_index] = target
+                    
+        self.applied = material_map
+        
+        
+# variant indexes by scene
+variant_indexes = {}
+
+def get_variant_index(scene):
+    key = scene.as_pointer()
+    index = variant_indexes.get(key)
+    if index is None:
+        index = VariantIndex()
+        variant_indexes[key] = index
+    return index
+    
+
+# materials of dematerialized variants kept for switching back, oldest are removed first
+MAX_KEPT_VARIANT_MATERIALS = 64
+
+class VariantMaterialCache:
+    """material templates, and the unused materials of recently dematerialized variants.
+       it lives between switches, so switching back doesn't rebuild node trees"""
+    def __init__(self):
+        self.material_templates = {}
+        
+        # (base material, shader key, image) -> material, oldest first
+        self.kept_materials = OrderedDict()
+        
+    @property
+    def addon_prefs(self):
+        return bpy.context.preferences.addons[__package__].preferences
         
+    def get_material_template(self, textured):
+        template = self.material_templates.get(textured)
+        if template is None:
+            template = import_helper.create_material_template(textured)
+            self.material_templates[textured] = template
+        return template
         
+    @staticmethod
+    def get_key(base_material, shader, image):
+        return (base_material.as_pointer(), shader.key(), image.as_pointer() if image is not None else 0)
+        
+    def get_materials(self):
+        """the templates and kept materials, none of them are on the scene"""
+        return set(self.material_templates.values()) | set(self.kept_materials.values())
+        
+    def keep(self, key, material):
+        old_material = self.kept_materials.pop(key, None)
+        if old_material is not None and old_material != material:
+            VariantMaterialCache.remove_unused(old_material)
+        self.kept_materials[key] = material
+        
+        while len(self.kept_materials) > MAX_KEPT_VARIANT_MATERIALS:
+            VariantMaterialCache.remove_unused(self.kept_materials.popitem(last=False)[1])
+            
+    def take(self, key):
+        """a kept material for this key, or None"""
+        material = self.kept_materials.pop(key, None)
+        if material is None:
+            return None
+        try:
+            material.name
+        except ReferenceError:
+            # the user removed it
+            return None
+        return material
+        
+    @staticmethod
+    def remove_unused(material):
+        try:
+            if material.users == 0:
+                bpy.data.materials.remove(material)
+        except ReferenceError:
+            pass
+            
+    def forget(self):
+        """drop the references without removing anything, the datablocks may be gone"""
+        self.material_templates.clear()
+        self.kept_materials.clear()
+        
+    def clear(self):
+        """remove the templates and kept materials"""
+        for material in self.get_materials():
+            VariantMaterialCache.remove_unused(material)
+        self.forget()
+        
+        
+variant_material_cache = VariantMaterialCache()
+
+@persistent
+def clear_variant_caches(dummy):
+    """undo and file loads change datablocks behind the caches' back"""
+    variant_indexes.clear()
+    variant_material_cache.forget()
+    
+
 class VariantMaterial(PropertyGroup):
+    """the shader of one material slot in a variant. only the variant on the 
+       scene has a real material, the others just keep the shader"""
+    
+    # the materialized variant material, None while the variant isn't on the scene
     material: PointerProperty(
         name="Material",
         type=Material
         )
+        
+    base_material: PointerProperty(
+        name="Base Material",
+        type=Material
+        )
+        
+    has_shader: BoolProperty()
+    texture_name: StringProperty()
+    image: PointerProperty(type=Image)
+    diffuse_color: FloatVectorProperty(size=4, default=(1.0, 1.0, 1.0, 1.0))
+    ambient_color: FloatVectorProperty(size=4, default=(1.0, 1.0, 1.0, 1.0))
+    specular_color: FloatVectorProperty(size=4, default=(0.0, 0.0, 0.0, 0.0))
+    emissive_color: FloatVectorProperty(size=4, default=(0.0, 0.0, 0.0, 0.0))
+    shininess: FloatProperty()
+    
+    def get_base_material(self):
+        if self.base_material is not None:
+            return self.base_material
+        # variants made before shaders were stored only have a material
+        if self.material is not None:
+            return self.material.cloned_from
+        return None
     
+    def get_display_name(self):
+        if self.material is not None:
+            return self.material.name
+        return self.texture_name if self.texture_name != "" else "age:notexture"
+        
+    def set_shader(self, shader, image=None):
+        self.has_shader = True
+        self.texture_name = shader.name if shader.name is not None else ""
+        self.image = image
+        self.diffuse_color = shader.diffuse_color
+        self.ambient_color = shader.ambient_color
+        self.specular_color = shader.specular_color
+        self.emissive_color = shader.emissive_color
+        self.shininess = shader.shininess
+        
+    def copy_shader(self, variant_material):
+        self.base_material = variant_material.get_base_material()
+        self.has_shader = variant_material.has_shader
+        self.texture_name = variant_material.texture_name
+        self.image = variant_material.image
+        self.diffuse_color = variant_material.diffuse_color
+        self.ambient_color = variant_material.ambient_color
+        self.specular_color = variant_material.specular_color
+        self.emissive_color = variant_material.emissive_color
+        self.shininess = variant_material.shininess
+        
+    def get_shader(self):
+        """the shader to export, read from the material if there is one, since it may have been edited"""
+        if self.material is not None:
+            return export_helper.create_shader_from_material(self.material)
+            
+        shader = Shader()
+        shader.name = self.texture_name if self.texture_name != "" else None
+        shader.diffuse_color = list(self.diffuse_color)
+        shader.ambient_color = list(self.ambient_color)
+        shader.specular_color = list(self.specular_color)
+        shader.emissive_color = list(self.emissive_color)
+        shader.shininess = self.shininess
+        return shader
+        
+    def store_material(self):
+        """keep the shader of the material, so the material can be removed"""
+        if self.material is None:
+            return
+        image = None
+        for node in self.material.node_tree.nodes:
+            if node.type == "TEX_IMAGE" and node.image is not None:
+                image = node.image
+                break
+        self.base_material = self.get_base_material()
+        self.set_shader(export_helper.create_shader_from_material(self.material), image)
+        
+    def materialize(self, cache):
+        """create the material of this slot"""
+        if self.material is not None or not self.has_shader or self.get_base_material() is None:
+            return
+        shader = self.get_shader()
+        material = cache.take(cache.get_key(self.get_base_material(), shader, self.image))
+        if material is None:
+            # placeholder textures are the only images without a path
+            is_substituted_tex = self.image is not None and self.image.filepath_raw == ""
+            
+            material = import_helper.create_material_from_shader(shader, self.image, cache, is_substituted_tex)
+            material.name = helper.get_undupe_name(material.name) + "_variant"
+            material.cloned_from = self.get_base_material()
+        self.material = material
+        
+        
 class Variant(PropertyGroup):
     materials: CollectionProperty(
         name = "Materials",
@@ -35,62 +288,115 @@ class Variant(PropertyGroup):
     material_index: IntProperty()
     
     
-    def apply_to_scene(self):
-        for ob in bpy.data.objects:
-            if ob.type != 'MESH':
-                continue
+    def get_material_map(self):
+        """base material -> variant material"""
+        material_map = {}
+        for vm in self.materials:
+            if vm.material is not None and vm.material.cloned_from is not None:
+                material_map.setdefault(vm.material.cloned_from, vm.material)
+        return material_map
+        
+    def find_material(self, base_material):
+        """the variant material for a base material, or None"""
+        for vm in self.materials:
+            if vm.get_base_material() == base_material:
+                return vm
+        return None
+        
+    def materialize(self):
+        """create the materials of this variant"""
+        if all(vm.material is not None or not vm.has_shader for vm in self.materials):
+            return
+        for vm in self.materials:
+            vm.materialize(variant_material_cache)
             
-            # loop through this objects materials, and find ones to replace/revert
-            mtl_count = len(ob.data.materials)
-            for i in range(mtl_count):
-                mtl = ob.data.materials[i]
-                complementing_mtl = None
-                
-                for vm in self.materials:
-                    if vm.material.cloned_from == mtl.cloned_from or vm.material.cloned_from == mtl:
-                        complementing_mtl = vm.material
-                        break
-                 
-                if complementing_mtl is not None or mtl.cloned_from is not None:
-                    ob.data.materials[i] = complementing_mtl if complementing_mtl is not None else mtl.cloned_from
+    def dematerialize(self):
+        """store the shaders of this variant, and let go of its materials"""
+        for vm in self.materials:
+            material = vm.material
+            if material is None:
+                continue
+            vm.store_material()
+            vm.material = None
             
+            # variants of older files could share a material
+            if material.users > 0:
+                continue
+            if vm.get_base_material() is not None:
+                key = VariantMaterialCache.get_key(vm.get_base_material(), vm.get_shader(), vm.image)
+                variant_material_cache.keep(key, material)
+            else:
+                bpy.data.materials.remove(material)
+        
+    def apply_to_scene(self):
+        """materialize this variant, put it on the scene, and dematerialize the others"""
+        self.materialize()
+        get_variant_index(self.id_data).apply(self.get_material_map())
+        
+        for variant in self.id_data.angel.variants:
+            if variant != self:
+                variant.dematerialize()
             
     def clone_from(self, variant):
         for vm in variant.materials:
-            self.add_material(vm.material)
+            vm.store_material()
+            self.materials.add().copy_shader(vm)
     
     def add_material(self, material):
         # reject already added materials
-        for vm in self.materials:
-            if vm.material.cloned_from == material:
-                return None
+        base_material = material.cloned_from if material.cloned_from is not None else material
+        if self.find_material(base_material) is not None:
+            return None
 
         # add material
         variant_material = self.materials.add()
         
         material_copy = material.copy()
+        import_helper.clear_material_key(material_copy)
         
         if not material.name.lower().endswith("_variant"):
             material_copy.name = material.name + "_variant"
         
         # if we're cloning a clone, use it's cloned_from
-        if material.cloned_from is not None:
-            material_copy.cloned_from = material.cloned_from
-        else:
-            material_copy.cloned_from = material
+        material_copy.cloned_from = base_material
         
+        variant_material.base_material = base_material
         variant_material.material = material_copy
+        variant_material.store_material()
         
         return variant_material
         
+    def add_shader(self, base_material, shader, image=None):
+        """add a slot by its shader, the material is made when the variant is applied"""
+        if self.find_material(base_material) is not None:
+            return None
+            
+        variant_material = self.materials.add()
+        variant_material.base_material = base_material
+        variant_material.set_shader(shader, image)
+        return variant_material
+        
     def add_all_materials(self):
+        cached_materials = variant_material_cache.get_materials()
         for material in bpy.data.materials:
-            self.add_material(material)
+            if material not in cached_materials:
+                self.add_material(material)
     
+    def is_material_shared(self, material):
+        """check if another variant uses this material too"""
+        for variant in self.id_data.angel.variants:
+            if variant == self:
+                continue
+            for vm in variant.materials:
+                if vm.material == material:
+                    return True
+        return False
+        
     def remove_all_materials(self):
         for vm in self.materials:
             material = vm.material
-            bpy.data.materials.remove(material, do_unlink=True) # this is a cloned material, so we delete it once it's no longer used
+            if material is not None and not self.is_material_shared(material):
+                bpy.data.materials.remove(material, do_unlink=True) # this is a cloned material, so we delete it once it's no longer used
         self.materials.clear()
         
     def remove_material(self, material):
@@ -102,7 +408,8 @@ class Variant(PropertyGroup):
         if found_index >= 0:
             material = self.materials[found_index].material
             self.materials.remove(found_index)
-            bpy.data.materials.remove(material, do_unlink=True) # this is a cloned material, so we delete it once it's no longer used
+            if material is not None and not self.is_material_shared(material):
+                bpy.data.materials.remove(material, do_unlink=True) # this is a cloned material, so we delete it once it's no longer used
         return found_index >= 0
         
     
@@ -144,15 +451,7 @@ class AngelSceneData(PropertyGroup):
             variant.apply_to_scene()
     
     def revert_to_base_materials(self):
-        for ob in bpy.data.objects:
-            if ob.type != 'MESH':
-                continue
-            
-            mtl_count = len(ob.data.materials)
-            for i in range(mtl_count):
-                mtl = ob.data.materials[i]
-                original_mtl = mtl.cloned_from
-                ob.data.materials[i] = original_mtl if original_mtl is not None else mtl
+        get_variant_index(self.id_data).apply({})
                     
                     
     def get_selected_variant(self):
@@ -161,12 +460,23 @@ class AngelSceneData(PropertyGroup):
         return self.variants[self.selected_variant]
         
         
+variant_cache_handlers = (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post)
+
 def register():
     bpy.utils.register_class(VariantMaterial)
     bpy.utils.register_class(Variant)
     bpy.utils.register_class(AngelSceneData)
     
+    for handlers in variant_cache_handlers:
+        handlers.append(clear_variant_caches)
+    
 def unregister():
+    for handlers in variant_cache_handlers:
+        if clear_variant_caches in handlers:
+            handlers.remove(clear_variant_caches)
+    variant_indexes.clear()
+    variant_material_cache.clear()
+    
     bpy.utils.unregister_class(AngelSceneData)
     bpy.utils.unregister_class(Variant)
     bpy.utils.unregister_class(VariantMaterial)
@@ -0,0 +1,44 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Created by Dummiesman, 2016-2020
+#
+# ##### END LICENSE BLOCK #####
+
+# array functions shared by import and export. This module does not 
+# depend on bpy, so it can be used and tested outside of Blender.
+
+import numpy as np
+
+# grid size normals are snapped to when welding with a tolerance. normals are
+# unit length, so they don't use the positional tolerance
+NORMAL_WELD_TOLERANCE = 0.01
+
+def unique_rows(rows):
+    """find unique rows of a 2d array. returns the first index of each unique row in order
+       of appearance, and an array mapping every row to its unique row"""
+    rows = np.ascontiguousarray(rows)
+    row_view = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first_index, inverse = np.unique(row_view, return_index=True, return_inverse=True)
+    
+    # np.unique sorts by value, restore the order of appearance
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first_index[order], rank[inverse.ravel()]
+
+def weld_vertices(positions, normals, tolerance=0.0):
+    """merge vertices sharing a position and normal. With a tolerance > 0, positions are snapped
+       to a grid of that size and normals to a NORMAL_WELD_TOLERANCE grid before comparing, so
+       vertices merge when they fall in the same grid cell. returns the indices of the kept 
+       vertices, and a remap array from every input vertex to its kept vertex"""
+    if tolerance > 0:
+        rows = np.empty((len(positions), 6), dtype=np.int64)
+        rows[:, :3] = np.floor(positions / tolerance)
+        rows[:, 3:] = np.floor(normals / NORMAL_WELD_TOLERANCE)
+    else:
+        rows = np.hstack((positions, normals))
+        rows += 0.0 # -0.0 and 0.0 are the same vertex
+    return unique_rows(rows)
@@ -7,29 +7,119 @@
 #
 # ##### END LICENSE BLOCK #####
 
-import bpy, struct, mathutils
-from bpy_extras.io_utils import axis_conversion
-import math
-import io_scene_pkg.common_helpers as helper
+# this module is also used outside of Blender (see pkg_file), so
+# mathutils is only imported by the functions that need it
+import struct
+import io, math, mmap, os
+import numpy as np
+
+##########
+# STRUCT #
+##########
+STRUCT_UINT8 = struct.Struct('<B')
+STRUCT_UINT16 = struct.Struct('<H')
+STRUCT_UINT32 = struct.Struct('<L')
+STRUCT_FLOAT = struct.Struct('<f')
+STRUCT_FLOAT2 = struct.Struct('<ff')
+STRUCT_FLOAT3 = struct.Struct('<fff')
+STRUCT_COLOR4F = struct.Struct('<ffff')
+STRUCT_COLOR4D = struct.Struct('<BBBB')
+STRUCT_CFLOAT2 = struct.Struct('<HH')
+STRUCT_MATRIX3X4 = struct.Struct('<12f')
+
+##########
+# READER #
+##########
+class BinaryReader:
+    """Reads a file through a memory map, keeping its own offset. read() returns
+       memoryview slices, so nothing is copied until it's decoded"""
+    def __init__(self, source):
+        self.file = None
+        self.mmap = None
+        
+        if isinstance(source, str):
+            self.file = open(source, 'rb')
+            if os.fstat(self.file.fileno()).st_size > 0:
+                self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+            else:
+                self.view = memoryview(b'')
+        else:
+            self.view = memoryview(source).cast('B')
+            
+        self.size = len(self.view)
+        self.offset = 0
+    
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.offset + size, self.size)
+        data = self.view[self.offset:end]
+        self.offset = end
+        return data
+        
+    def unpack(self, st):
+        value = st.unpack_from(self.view, self.offset)
+        self.offset += st.size
+        return value
+        
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += self.size
+        self.offset = offset
+        return self.offset
+        
+    def tell(self):
+        return self.offset
+    
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
 ########
 # READ #
 ########
+def unpack(file, st):
+    """unpack a precompiled struct from a BinaryReader or a file object"""
+    if isinstance(file, BinaryReader):
+        return file.unpack(st)
+    return st.unpack(file.read(st.size))
+    
 def read_angel_string(file):
-    str_len = struct.unpack('B', file.read(1))[0]
+    str_len = unpack(file, STRUCT_UINT8)[0]
     if str_len == 0:
         return ''
     else:
-        return_string = file.read(str_len - 1).decode("utf-8")
+        return_string = str(file.read(str_len - 1), "utf-8")
         file.seek(1, 1)
         return return_string
 
+def read_uint16(file):
+    return unpack(file, STRUCT_UINT16)[0]
+
+
+def read_uint32(file):
+    return unpack(file, STRUCT_UINT32)[0]
+
+
 def read_float(file):
-    return struct.unpack('<f', file.read(4))[0]
+    return unpack(file, STRUCT_FLOAT)[0]
 
 
 def read_float3(file):
-    return struct.unpack('<fff', file.read(12))
+    return unpack(file, STRUCT_FLOAT3)
 
 
 def read_cfloat3(file):
@@ -39,28 +129,56 @@ def read_cfloat3(file):
 
 
 def read_cfloat2(file):
-    stc = struct.unpack('<HH', file.read(4))
+    stc = unpack(file, STRUCT_CFLOAT2)
     return (stc[0]/128) - 128, (stc[1]/128) - 128
 
 
 def read_float2(file):
-    return struct.unpack('<ff', file.read(8))
+    return unpack(file, STRUCT_FLOAT2)
 
 
 def read_color4f(file):
-    return struct.unpack('<ffff', file.read(16))
+    return unpack(file, STRUCT_COLOR4F)
 
 
 def read_color4d(file):
-    c4d = struct.unpack('BBBB', file.read(4))
+    c4d = unpack(file, STRUCT_COLOR4D)
     return [c4d[0]/255, c4d[1]/255, c4d[2]/255, c4d[3]/255]
 
 
+def get_vertex_dtype(FVF_FLAGS, compressed):
+    """build a numpy dtype matching one PKG vertex"""
+    fields = [('position', '<f4', (3,))]
+    if FVF_FLAGS.has_flag("D3DFVF_NORMAL"):
+        fields.append(('normal', 'u1', (3,)) if compressed else ('normal', '<f4', (3,)))
+    if FVF_FLAGS.has_flag("D3DFVF_DIFFUSE"):
+        fields.append(('diffuse', 'u1', (4,)))
+    if FVF_FLAGS.has_flag("D3DFVF_SPECULAR"):
+        fields.append(('specular', 'u1', (4,)))
+    if FVF_FLAGS.has_flag("D3DFVF_TEX1"):
+        fields.append(('uv', '<u2', (2,)) if compressed else ('uv', '<f4', (2,)))
+    return np.dtype(fields)
+
+
+def read_vertex_block(file, FVF_FLAGS, compressed, count):
+    """read count vertices into a structured array"""
+    dtype = get_vertex_dtype(FVF_FLAGS, compressed)
+    return np.frombuffer(file.read(dtype.itemsize * count), dtype=dtype, count=count)
+
+
 def read_matrix3x4(file):
-    row1r = list(struct.unpack('<fff', file.read(12)))
-    row2r = list(struct.unpack('<fff', file.read(12)))
-    row3r = list(struct.unpack('<fff', file.read(12)))
-    translation = struct.unpack('<fff', file.read(12))
+    return convert_matrix3x4(unpack(file, STRUCT_MATRIX3X4))
+
+
+def convert_matrix3x4(mtx_data):
+    """convert 12 raw PKG matrix floats into a Blender matrix"""
+    import mathutils
+    from bpy_extras.io_utils import axis_conversion
+    
+    row1r = mtx_data[0:3]
+    row2r = mtx_data[3:6]
+    row3r = mtx_data[6:9]
+    translation = mtx_data[9:12]
     
     # transpose the matrix
     col1 = [row1r[0], row2r[0], row3r[0], translation[0]]
@@ -86,6 +204,9 @@ def read_matrix3x4(file):
 # WRITE #
 #########
 def write_matrix3x4(file, matrix):  
+    import mathutils
+    from bpy_extras.io_utils import axis_conversion
+    
     # passed by ref, don't mess that up
     matrix = matrix.copy() 
     
@@ -108,11 +229,11 @@ def write_matrix3x4(file, matrix):
 
 def write_angel_string(file, strng):
     if strng is not None and len(strng) > 0:
-        file.write(struct.pack('B', len(strng)+1))
+        file.write(STRUCT_UINT8.pack(len(strng)+1))
         file.write(bytes(strng, 'UTF-8'))
         file.write(bytes('\x00', 'UTF-8'))
     else:
-        file.write(struct.pack('B', 0))
+        file.write(STRUCT_UINT8.pack(0))
 
 
 def write_float2(file, data):
@@ -128,7 +249,7 @@ def write_color4d(file, color, alpha=1):
     g = min(255, int(color[1] * 255))
     b = min(255, int(color[2] * 255))
     a = min(255, int(alpha * 255))
-    file.write(struct.pack('BBBB', r, g, b, a))
+    file.write(STRUCT_COLOR4D.pack(r, g, b, a))
 
 
 def write_color4f(file, color, alpha=1):
@@ -138,4 +259,11 @@ def write_color4f(file, color, alpha=1):
 def write_file_header(file, name, length=0):
     file.write(bytes('FILE', 'utf-8'))
     write_angel_string(file, name)
-    file.write(struct.pack('L', length))
\ No newline at end of file
+    file.write(STRUCT_UINT32.pack(length))
+
+
+def write_file(file, name, data):
+    """write a whole FILE entry, data is its serialized contents"""
+    header = io.BytesIO()
+    write_file_header(header, name, len(data))
+    file.write(b''.join((header.getvalue(), data)))
\ No newline at end of file
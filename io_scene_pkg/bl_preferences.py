@@ -13,6 +13,21 @@ import random
 
 import bpy
 
+import io_scene_pkg.common_helpers as helper
+import io_scene_pkg.texture_cache as texture_cache
+
+class ClearTextureCacheOperator(bpy.types.Operator):
+    """Remove every decoded texture from the texture cache"""
+    bl_idname = "angel.clear_texture_cache"
+    bl_label = "Clear Texture Cache"
+    
+    def execute(self, context):
+        addon_prefs = context.preferences.addons[__package__].preferences
+        cache_settings = helper.get_texture_cache_settings(addon_prefs)
+        if cache_settings is not None:
+            texture_cache.clear(cache_settings[0])
+        return {'FINISHED'}
+
 class PkgPreferences(bpy.types.AddonPreferences):
     bl_idname = __package__
 
@@ -37,17 +52,51 @@ class PkgPreferences(bpy.types.AddonPreferences):
         description = "Use alpha hash instead alpha blend on transparent materials. May make transparency appear incorrectly, but solves objects rendering atop each other",
         default = False
     )
+    
+    max_texture_size: bpy.props.IntProperty(
+        name="Max Texture Size",
+        description = "Import TEX files at the largest mip level no bigger than this, saving memory in large scenes. 0 imports full resolution",
+        default = 0,
+        min = 0,
+        soft_max = 4096
+    )
+    
+    use_texture_cache: bpy.props.BoolProperty(
+        name="Cache Decoded Textures", 
+        description = "Keep decoded TEX files on disk, so later imports don't decode them again",
+        default = False
+    )
+    
+    texture_cache_size: bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description = "Least recently used textures are removed from the cache when it grows past this size",
+        default = 512,
+        min = 1
+    )
+    
+    texture_cache_path: bpy.props.StringProperty(
+        name="Cache Path",
+        description = "Folder for the texture cache. Leave empty to use the Blender user data folder",
+        subtype = 'DIR_PATH'
+    )
   
     def draw(self, context):
         layout = self.layout
         layout.prop(self, "substitute_textures")
+        layout.prop(self, "max_texture_size")
+        layout.prop(self, "use_texture_cache")
+        col = layout.column()
+        col.enabled = self.use_texture_cache
+        col.prop(self, "texture_cache_size")
+        col.prop(self, "texture_cache_path")
+        col.operator("angel.clear_texture_cache")
         layout.prop(self, "use_alpha_hash")
         layout.prop(self, "use_gamepath")
         layout.prop(self, "gamepath")
 
 
 
-classes = (PkgPreferences,)
+classes = (ClearTextureCacheOperator, PkgPreferences)
 
 register_factory, unregister_factory = bpy.utils.register_classes_factory(classes)
 
@@ -7,12 +7,69 @@
 #
 # ##### END LICENSE BLOCK #####
 
-import bpy
-import os, struct
+import bpy, mathutils
+import os, struct, time
 import os.path as path
+import numpy as np
 
 from io_scene_pkg.tex_file import TEXFile
+from io_scene_pkg.array_helper import unique_rows
+import io_scene_pkg.texture_cache as texture_cache
 
+def create_material_node_setup(material, textured=True):
+    """build the node setup of a PKG shader on a new material. nodes are named after their 
+       labels, so they can be found again on copies of the material"""
+    material.use_nodes = True
+    material.use_backface_culling = True
+    node_tree = material.node_tree
+    
+    bsdf = node_tree.nodes["Principled BSDF"]
+    bsdf.inputs['Emission'].default_value = (0, 0, 0, 1)
+    bsdf.inputs['Specular'].default_value = 0.0
+    bsdf.inputs['Roughness'].default_value = 0
+    
+    if not textured:
+        return
+    
+    # create image node
+    tex_image_node = node_tree.nodes.new('ShaderNodeTexImage')
+    tex_image_node.name = "Image Texture"
+    tex_image_node.location = mathutils.Vector((-640.0, 20.0))
+    
+    # create diffuse blend node
+    blend_node = node_tree.nodes.new('ShaderNodeMixRGB')
+    blend_node.inputs['Color2'].default_value = (1, 1, 1, 1)
+    blend_node.inputs['Fac'].default_value = 1.0
+    blend_node.blend_type = 'MULTIPLY'
+    blend_node.name = blend_node.label = "Diffuse Color"
+    blend_node.location = mathutils.Vector((-260.0, 160.0))
+    
+    # hook up diffuse
+    node_tree.links.new(blend_node.inputs['Color1'], tex_image_node.outputs['Color'])
+    node_tree.links.new(bsdf.inputs['Base Color'], blend_node.outputs['Color'])
+    
+    # create emissive blend node
+    blend_node = node_tree.nodes.new('ShaderNodeMixRGB')
+    blend_node.inputs['Color2'].default_value = (0, 0, 0, 1)
+    blend_node.inputs['Fac'].default_value = 1.0
+    blend_node.blend_type = 'MULTIPLY'
+    blend_node.name = blend_node.label = "Emission Color"
+    blend_node.location = mathutils.Vector((-260.0, -20.0))
+    
+    node_tree.links.new(blend_node.inputs['Color1'], tex_image_node.outputs['Color'])
+    node_tree.links.new(bsdf.inputs['Emission'], blend_node.outputs['Color'])
+    
+    # create the alpha blend node
+    blend_node = node_tree.nodes.new('ShaderNodeMath')
+    blend_node.inputs[0].default_value = 1.0
+    blend_node.operation = 'MULTIPLY'
+    blend_node.name = blend_node.label = "Alpha"
+    blend_node.location = mathutils.Vector((-260.0, -200.0))
+    
+    node_tree.links.new(blend_node.inputs[1], tex_image_node.outputs['Alpha'])
+    node_tree.links.new(bsdf.inputs['Alpha'], blend_node.outputs[0])
+    
+    
 def make_placeholder_texture(name):
     ptw = 2
     pth = 2
@@ -35,6 +92,52 @@ def make_placeholder_texture(name):
     im.update()
     return im
     
+# directory listings used to resolve files without probing the disk, keyed by directory.
+# each one is [directory mtime, time it was last validated, {lowercase name : name}]
+directory_listings = {}
+
+# seconds before a listing is validated against the directory mtime again
+DIRECTORY_VALIDATE_INTERVAL = 2.0
+
+def get_directory_listing(directory):
+    """get the files of a directory by their lowercase name, listing it only when it changed"""
+    now = time.monotonic()
+    listing = directory_listings.get(directory)
+    if listing is not None and now - listing[1] < DIRECTORY_VALIDATE_INTERVAL:
+        return listing[2]
+    
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        mtime = None # missing directories are remembered too
+        
+    if listing is not None and listing[0] == mtime:
+        listing[1] = now
+        return listing[2]
+    
+    files = {}
+    if mtime is not None:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        files.setdefault(entry.name.lower(), entry.name)
+        except OSError:
+            pass
+            
+    directory_listings[directory] = [mtime, now, files]
+    return files
+    
+def clear_directory_listings():
+    """forget all listings, imports start with this so they don't rely on mtimes from earlier ones"""
+    directory_listings.clear()
+    
+def find_file_case_insensitive(file_path):
+    """get the path of an existing file matching file_path in any case, or None"""
+    directory, file_name = path.split(file_path)
+    found_name = get_directory_listing(directory).get(file_name.lower())
+    return path.join(directory, found_name) if found_name is not None else None
+    
 def find_file_with_game_fallback(file, search_path, subfolder = None, ignore_subdir_on_search_path = False):
     # first search the search_path
     find_path = (path.abspath(path.join(search_path, file))
@@ -42,8 +145,9 @@ def find_file_with_game_fallback(file, search_path, subfolder = None, ignore_sub
                  else path.abspath(path.join(search_path, subfolder, file)))
     
     #print("find_path initial:" + find_path)
-    if path.isfile(find_path):
-        return find_path
+    found_path = find_file_case_insensitive(find_path)
+    if found_path is not None:
+        return found_path
     
     # then search game dir
     preferences = bpy.context.preferences
@@ -53,14 +157,43 @@ def find_file_with_game_fallback(file, search_path, subfolder = None, ignore_sub
                      if subfolder is not None 
                      else path.abspath(path.join(addon_prefs.gamepath, file)))
         #print("find_path game:" + find_path)
-        if path.isfile(find_path):
-            return find_path
+        found_path = find_file_case_insensitive(find_path)
+        if found_path is not None:
+            return found_path
 
     # wasn't found in game dir or search_path
     return None
 
 
-def load_texture_from_path(file_path, use_placeholder_if_missing=True):
+def get_texture_cache_settings(addon_prefs):
+    """(directory, size limit in bytes) of the decoded texture cache, or None if it's disabled"""
+    if not addon_prefs.use_texture_cache:
+        return None
+    
+    if addon_prefs.texture_cache_path != "":
+        directory = path.abspath(bpy.path.abspath(addon_prefs.texture_cache_path))
+    else:
+        directory = bpy.utils.user_resource('DATAFILES', "pkg_texture_cache")
+    return (directory, addon_prefs.texture_cache_size * 1024 * 1024)
+    
+
+def read_tex_file(file_path, max_size=0, cache_settings=None):
+    """read and decode a TEX file, or get it from the texture cache. 
+       this doesn't touch Blender data, so it can run on a worker thread"""
+    if cache_settings is not None:
+        cached = texture_cache.load(cache_settings[0], file_path, max_size)
+        if cached is not None:
+            return cached
+    
+    tf = TEXFile(file_path, max_size)
+    pixels = tf.get_pixels() if tf.is_valid() else None
+    
+    if cache_settings is not None and pixels is not None:
+        texture_cache.store(cache_settings[0], file_path, max_size, tf, pixels, cache_settings[1])
+    return (tf, pixels)
+
+
+def load_texture_from_path(file_path, use_placeholder_if_missing=True, tex_data=None):
     # extract the filename for manual image format names
     imgname=path.basename(file_path)
     imgname=os.path.splitext(imgname)[0]
@@ -69,9 +202,14 @@ def load_texture_from_path(file_path, use_placeholder_if_missing=True):
         return make_placeholder_texture(imgname)
     
     if file_path.lower().endswith(".tex"):
-        tf = TEXFile(file_path)
-        if tf.is_valid():
-            tf_img = tf.to_blender_image(imgname)
+        # TEX files may have been decoded in the background already
+        if tex_data is None:
+            preferences = bpy.context.preferences
+            addon_prefs = preferences.addons[__package__].preferences
+            tex_data = read_tex_file(file_path, addon_prefs.max_texture_size, get_texture_cache_settings(addon_prefs))
+        tf, pixels = tex_data
+        if pixels is not None:
+            tf_img = tf.to_blender_image(imgname, pixels=pixels)
             tf_img.filepath_raw = file_path # set filepath manually for TEX stuff, since we make it ourself
             return tf_img
         else:
@@ -83,18 +221,65 @@ def load_texture_from_path(file_path, use_placeholder_if_missing=True):
     return None    
 
     
-def try_load_texture(tex_name, search_path):
+def try_load_texture(tex_name, search_path, cache=None):
     existing_image = bpy.data.images.get(tex_name)
     if existing_image is not None:
         return existing_image
     
+    # textures that were already searched for in this import, found or not
+    cache_key = (tex_name.lower(), search_path)
+    if cache is not None and cache_key in cache.textures:
+        return cache.textures[cache_key]
+    
+    # TEX files decoding in the background only need their image made
+    if cache is not None and cache_key in cache.texture_futures:
+        file_path, future = cache.texture_futures.pop(cache_key)
+        try:
+            image = load_texture_from_path(file_path, tex_data=future.result())
+        except Exception as e:
+            print("Invalid TEX file: " + file_path + ", " + str(e))
+            image = None
+            
+        # the TEX file is broken, other formats may still be there
+        if image is None:
+            image = find_and_load_standard_texture(tex_name, search_path)
+    else:
+        image = find_and_load_texture(tex_name, search_path)
+        
+    if cache is not None:
+        cache.textures[cache_key] = image
+    return image
+    
+    
+def prefetch_texture(tex_name, search_path, cache):
+    """start decoding a TEX file on the cache texture pool, try_load_texture picks up the result.
+       other image formats are loaded by Blender, which has to happen on the main thread"""
+    cache_key = (tex_name.lower(), search_path)
+    if (bpy.data.images.get(tex_name) is not None or
+        cache_key in cache.textures or
+        cache_key in cache.texture_futures):
+        return
+        
+    found_file = find_file_with_game_fallback(tex_name + ".tex", search_path, "texture")
+    if found_file is not None:
+        # preferences can't be read from the worker, pass them along
+        cache.texture_futures[cache_key] = (found_file, cache.get_texture_pool().submit(read_tex_file, 
+                                                                                        found_file, 
+                                                                                        cache.addon_prefs.max_texture_size,
+                                                                                        cache.texture_cache_settings))
+    
+    
+def find_and_load_texture(tex_name, search_path):
     find_file = tex_name + ".tex"
     found_file = find_file_with_game_fallback(find_file, search_path, "texture")
     if found_file is not None:
         tf_img = load_texture_from_path(found_file)
         if tf_img is not None:
             return tf_img
+    return find_and_load_standard_texture(tex_name, search_path)
     
+def find_and_load_standard_texture(tex_name, search_path):
+    """find and load a texture in a format Blender reads itself"""
     standard_extensions = (".tga", ".bmp", ".png")
     for ext in standard_extensions:
         find_file = tex_name + ext
@@ -151,5 +336,15 @@ def is_matrix_object(obj):
 def convert_vecspace_to_blender(vtx):
     return (vtx[0] * -1, vtx[2], vtx[1])
     
+def convert_vecspace_to_blender_array(vtx):
+    result = vtx[:, (0, 2, 1)]
+    result[:, 0] *= -1
+    return result
+
 def convert_vecspace_to_mm2(vtx):
-    return (vtx[0] * -1, vtx[2], vtx[1])
\ No newline at end of file
+    return (vtx[0] * -1, vtx[2], vtx[1])
+    
+def convert_vecspace_to_mm2_array(vtx):
+    result = vtx[:, (0, 2, 1)]
+    result[:, 0] *= -1
+    return result
\ No newline at end of file
@@ -7,8 +7,9 @@
 #
 # ##### END LICENSE BLOCK #####
 
-import bpy, bmesh
+import bpy
 import struct
+import numpy as np
 
 from io_scene_pkg.shader_set import (ShaderSet, Shader)
 import io_scene_pkg.common_helpers as helper
@@ -106,58 +107,49 @@ def create_shader_from_material(mat):
     
     return shader
     
-def get_used_materials(ob, modifiers):
-    """search for used materials at object level"""
-    used_materials = []
-    checked_material_indices = {}
-    
-    # create temp mesh
-    temp_mesh = None
-    if modifiers:
-        dg = bpy.context.evaluated_depsgraph_get()
-        eval_obj = ob.evaluated_get(dg)
-        temp_mesh = eval_obj.to_mesh()
-    else:
-        temp_mesh = ob.to_mesh()
-    
-    # get bmesh
-    bm = bmesh.new()
-    bm.from_mesh(temp_mesh)
+def get_used_materials(ob, mesh):
+    """search for used materials at object level, mesh is the evaluated mesh of the object"""
+    face_material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", face_material_indices)
     
-    # look for used materials
-    for f in bm.faces:
-      if (not f.material_index in checked_material_indices 
-          and f.material_index >= 0 and f.material_index < len(ob.data.materials) 
-          and ob.data.materials[f.material_index] is not None):
+    # look for used materials, in order of first use
+    used_indices, first_face = np.unique(face_material_indices, return_index=True)
+    used_materials = []
+    for material_index in used_indices[np.argsort(first_face)]:
+      if (material_index >= 0 and material_index < len(ob.data.materials) 
+          and ob.data.materials[material_index] is not None):
 
-        material = ob.data.materials[f.material_index]
+        material = ob.data.materials[material_index]
         if material.cloned_from is not None: # we want the reference to the ORIGINAL
             material = material.cloned_from
         used_materials.append(material)
-        checked_material_indices[f.material_index] = True
-    
-    # finish off
-    bm.free()
     
     return used_materials
 
-def create_material_remap(modifiers):
-    all_used_mats = []
-    for ob in bpy.context.scene.objects:
-        if ob.type != 'MESH':
-            continue
+class ExportSession:
+    """evaluates the objects of an export one at a time, and gives 
+       materials their shader index as the exported objects use them"""
+    def __init__(self, modifiers):
+        self.depsgraph = bpy.context.evaluated_depsgraph_get() if modifiers else None
+        self.evaluated_object = None
+        
+        # material name -> shader index
+        self.material_remap = {}
+        
+    def evaluate(self, ob):
+        """get the mesh to export for an object, it lives until release is called"""
+        self.release()
+        self.evaluated_object = ob.evaluated_get(self.depsgraph) if self.depsgraph is not None else ob
+        return self.evaluated_object.to_mesh()
         
-        used_mats = get_used_materials(ob, modifiers)
-        for mat in used_mats:
-            if not mat in all_used_mats:
-                all_used_mats.append(mat)
-     
-    material_map = {}
-    material_idx = 0
-    for mtl in all_used_mats:
-        material_map[mtl.name] = material_idx
-        material_idx += 1
-    return material_map
+    def release(self):
+        """free the mesh of the last evaluated object"""
+        if self.evaluated_object is not None:
+            self.evaluated_object.to_mesh_clear()
+            self.evaluated_object = None
+            
+    def get_material_index(self, material):
+        return self.material_remap.setdefault(material.name, len(self.material_remap))
  
 def bounds(obj):
     """get the bounds of an object"""
@@ -185,10 +177,10 @@ def bounds(obj):
 
 def write_matrix_standard(object, file):
     bnds = bounds(object)
-    file.write(struct.pack('fff', *helper.convert_vecspace_to_mm2((bnds.x.min * -1, bnds.y.min, bnds.z.min)))) # have to do * -1 for some reason
-    file.write(struct.pack('fff', *helper.convert_vecspace_to_mm2((bnds.x.max * -1, bnds.y.max, bnds.z.max)))) # have to do * -1 for some reason
-    file.write(struct.pack('fff', *helper.convert_vecspace_to_mm2(object.location))) # write this twice. one is pivot and one is origin
-    file.write(struct.pack('fff', *helper.convert_vecspace_to_mm2(object.location)))
+    file.write(struct.pack('<fff', *helper.convert_vecspace_to_mm2((bnds.x.min * -1, bnds.y.min, bnds.z.min)))) # have to do * -1 for some reason
+    file.write(struct.pack('<fff', *helper.convert_vecspace_to_mm2((bnds.x.max * -1, bnds.y.max, bnds.z.max)))) # have to do * -1 for some reason
+    file.write(struct.pack('<fff', *helper.convert_vecspace_to_mm2(object.location))) # write this twice. one is pivot and one is origin
+    file.write(struct.pack('<fff', *helper.convert_vecspace_to_mm2(object.location)))
 
                                            
 def write_matrix(meshname, object, pkg_path):
@@ -207,67 +199,97 @@ def write_matrix(meshname, object, pkg_path):
     return
 
     
-def prepare_mesh_data(mesh, material_index, tessface):
-  """build mesh data for a PKG file"""
-  # initialize lists for conversion
-  cmtl_tris = []
-  cmtl_indices = []
-  cmtl_verts = []
-  cmtl_uvs = []
-  cmtl_cols = []
-  
-  # build the mesh data we need
-  uv_layer = mesh.loops.layers.uv.active
-  vc_layer = mesh.loops.layers.color.active
-
-  # build tris that are in this material pass
-  for lt in tessface:
-      if lt[0].face.material_index == material_index:
-        cmtl_tris.append(lt)
-
-  # convert per face to per vertex indices
-  index_remap_table = {}
-  for lt in cmtl_tris:
-      #funstuff :|
-      indices = [-1, -1, -1]
-      for x in range(3):
-          l = lt[x]
-          # prepare our hash entry
-          uv_hash = "NOUV"
-          col_hash = "NOCOL"
-          pos_hash = str(l.vert.co)
-          nrm_hash = str(l.vert.normal)
-          if uv_layer is not None:
-              uv_hash = str(l[uv_layer].uv)
-          if vc_layer is not None:
-              col_hash = str(l[vc_layer])
-          index_hash = uv_hash + "|" + col_hash + "|" + pos_hash + "|" + nrm_hash
-
-          # do we already have a vertex for this?
-          if index_hash in index_remap_table:
-              indices[x] = index_remap_table[index_hash]
-          else:
-              # get what our next index will be and append to remap table
-              next_index = len(cmtl_verts)
-              index_remap_table[index_hash] = next_index
-              indices[x] = next_index
-
-              # add neccessary data to remapping tables
-              cmtl_verts.append(l.vert)
-
-              if uv_layer is not None:
-                  cmtl_uvs.append(l[uv_layer].uv)
-              else:
-                  cmtl_uvs.append((0,0))
-
-              if vc_layer is not None:
-                  cmtl_cols.append(l[vc_layer])
-              else:
-                  cmtl_cols.append((0,0,0,0))
-
-      # finally append this triangle                
-      cmtl_indices.append(indices)  
+def prepare_mesh_data(mesh, matrix=None):
+    """build mesh data for a PKG file. matrix (4x4 array) transforms the positions.
+       returns {material index: (indices, positions, normals, uvs, colors)} as arrays in MM2 space"""
+    mesh.calc_loop_triangles()
+    num_triangles = len(mesh.loop_triangles)
+    num_loops = len(mesh.loops)
+    num_vertices = len(mesh.vertices)
+    
+    # pull everything out of the mesh
+    triangle_loops = np.empty(num_triangles * 3, dtype=np.int32)
+    triangle_materials = np.empty(num_triangles, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", triangle_loops)
+    mesh.loop_triangles.foreach_get("material_index", triangle_materials)
+    
+    loop_vertices = np.empty(num_loops, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    
+    vertex_positions = np.empty(num_vertices * 3, dtype=np.float32)
+    vertex_normals = np.empty(num_vertices * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", vertex_positions)
+    mesh.vertices.foreach_get("normal", vertex_normals)
+    
+    loop_uvs = np.zeros(num_loops * 2, dtype=np.float32)
+    uv_layer = mesh.uv_layers.active
+    if uv_layer is not None:
+        uv_layer.data.foreach_get("uv", loop_uvs)
+        
+    loop_colors = np.zeros(num_loops * 4, dtype=np.float32)
+    vc_layer = mesh.vertex_colors.active
+    if vc_layer is not None:
+        vc_layer.data.foreach_get("color", loop_colors)
+    
+    # bucket triangles by material, keeping their order within a material
+    order = np.argsort(triangle_materials, kind='stable')
+    triangle_materials = triangle_materials[order]
+    loops = triangle_loops.reshape((-1, 3))[order].ravel()
+    vertices = loop_vertices[loops]
+    
+    # one row per triangle corner, corners with the same row become one PKG vertex
+    rows = np.empty((len(loops), 13), dtype=np.float32)
+    rows[:, 0] = np.repeat(triangle_materials, 3)
+    rows[:, 1:4] = vertex_positions.reshape((-1, 3))[vertices]
+    rows[:, 4:7] = vertex_normals.reshape((-1, 3))[vertices]
+    rows[:, 7:9] = loop_uvs.reshape((-1, 2))[loops]
+    rows[:, 9:13] = loop_colors.reshape((-1, 4))[loops]
+    rows += 0.0 # -0.0 and 0.0 are the same vertex
+    
+    first_index, index_remap = helper.unique_rows(rows)
+    unique_rows = rows[first_index]
+    
+    positions = unique_rows[:, 1:4]
+    if matrix is not None:
+        positions = positions @ matrix[:3, :3].T + matrix[:3, 3]
+    positions = helper.convert_vecspace_to_mm2_array(positions)
+    normals = helper.convert_vecspace_to_mm2_array(unique_rows[:, 4:7])
+    uvs = unique_rows[:, 7:9].copy()
+    uvs[:, 1] = (uvs[:, 1] - 1) * -1
+    colors = unique_rows[:, 9:13]
+    
+    # unique rows are in order of appearance, and triangles are sorted by material,
+    # so each material has a contiguous range of triangles and vertices
+    indices = index_remap.reshape((-1, 3))
+    vertex_materials = unique_rows[:, 0].astype(np.int32)
+    
+    sections = {}
+    for material_index in np.unique(triangle_materials):
+        triangle_start, triangle_end = np.searchsorted(triangle_materials, (material_index, material_index + 1))
+        vertex_start, vertex_end = np.searchsorted(vertex_materials, (material_index, material_index + 1))
+        sections[int(material_index)] = (indices[triangle_start:triangle_end] - vertex_start,
+                                         positions[vertex_start:vertex_end],
+                                         normals[vertex_start:vertex_end],
+                                         uvs[vertex_start:vertex_end],
+                                         colors[vertex_start:vertex_end])
+    return sections
   
-  # return mesh data :)
-  return (cmtl_indices, cmtl_verts, cmtl_uvs, cmtl_cols)
-  
\ No newline at end of file
+def get_color_bytes(colors):
+    """float colors to opaque PKG byte colors"""
+    color_bytes = np.full((len(colors), 4), 255, dtype=np.uint8)
+    color_bytes[:, :3] = np.clip(colors[:, :3] * 255, 0, 255).astype(np.uint8)
+    return color_bytes
+    
+def get_vertex_block(FVF_FLAGS, positions, normals, uvs, colors):
+    """PKG vertices as a structured array"""
+    block = np.zeros(len(positions), dtype=bin.get_vertex_dtype(FVF_FLAGS, False))
+    block['position'] = positions
+    if FVF_FLAGS.has_flag("D3DFVF_NORMAL"):
+        block['normal'] = normals
+    if FVF_FLAGS.has_flag("D3DFVF_DIFFUSE"):
+        block['diffuse'] = get_color_bytes(colors)
+    if FVF_FLAGS.has_flag("D3DFVF_SPECULAR"):
+        block['specular'] = get_color_bytes(colors)
+    if FVF_FLAGS.has_flag("D3DFVF_TEX1"):
+        block['uv'] = uvs
+    return block
@@ -7,8 +7,9 @@
 #
 # ##### END LICENSE BLOCK #####
 
-import bpy, bmesh
-import os, time, struct
+import bpy
+import os, io, time, struct
+import numpy as np
 from functools import cmp_to_key
 
 import os.path as path
@@ -28,6 +29,13 @@ pkg_path = None
 global material_remap_table
 material_remap_table = {}
 
+# mesh data of a material slot without faces
+EMPTY_SECTION = (np.zeros((0, 3), dtype=np.int64), 
+                 np.zeros((0, 3), dtype=np.float32), 
+                 np.zeros((0, 3), dtype=np.float32), 
+                 np.zeros((0, 2), dtype=np.float32), 
+                 np.zeros((0, 4), dtype=np.float32))
+
 
 ######################################################
 # GLOBAL LISTS
@@ -199,31 +207,24 @@ def export_xrefs(file, selected_only):
 
     # export xrefs
     if len(xref_objects) > 0:
-        bin.write_file_header(file, "xrefs")
-        num_xrefs = 0
-        xref_num_offset = file.tell()
-        file.write(struct.pack('L', 0))
+        data = io.BytesIO()
+        data.write(struct.pack('<L', len(xref_objects)))
         for obj in xref_objects:
-            num_xrefs += 1
             #write matrix
-            bin.write_matrix3x4(file, obj.matrix_basis)
+            bin.write_matrix3x4(data, obj.matrix_basis)
            
             # write xref name
             xref_name = helper.get_undupe_name(obj.name[5:]) + "\x00max"
             null_length = 32 - len(xref_name)
             
-            file.write(bytes(xref_name, 'utf-8'))
-            file.write(bytes('\x00' * null_length, 'utf-8'))
+            data.write(bytes(xref_name, 'utf-8'))
+            data.write(bytes('\x00' * null_length, 'utf-8'))
                 
-        file_length = file.tell() - xref_num_offset
-        file.seek(xref_num_offset - 4, 0)
-        file.write(struct.pack('LL', file_length, num_xrefs))
-        file.seek(0, 2)
+        bin.write_file(file, "xrefs", data.getvalue())
 
 
 def export_offset(file):
-    bin.write_file_header(file, "offset", 12)
-    file.write(struct.pack('fff', 0, 0, 0))
+    bin.write_file(file, "offset", struct.pack('<fff', 0, 0, 0))
 
 
 def export_shaders(file, context, type="byte"):
@@ -240,9 +241,8 @@ def export_shaders(file, context, type="byte"):
         write_dummy_variant = True
         num_variants = 1
     
-    # write file header and record offset
-    bin.write_file_header(file, "shaders")
-    shaders_data_offset = file.tell()
+    # FILE contents are built in memory, so the length is known when it's written
+    data = io.BytesIO()
     
     # prepare shaders header
     shadertype_raw = num_variants
@@ -251,7 +251,7 @@ def export_shaders(file, context, type="byte"):
     shaders_per_paintjob = len(material_remap_table)
     
     # write header
-    file.write(struct.pack('LL', shadertype_raw, shaders_per_paintjob))
+    data.write(struct.pack('<LL', shadertype_raw, shaders_per_paintjob))
     
     # write material sets
     ordered_material_remap = sorted(material_remap_table.items(), key =lambda x: x[1])
@@ -263,7 +263,7 @@ def export_shaders(file, context, type="byte"):
             
             # create a shader for it, and write it
             shader = export_helper.create_shader_from_material(material)
-            shader.write(file, type)
+            shader.write(data, type)
     else:
         # write out user created variants
         for variant in variants:
@@ -271,50 +271,39 @@ def export_shaders(file, context, type="byte"):
                 material_id = material_kvp[0]
                 material = bpy.data.materials[material_id]
                 
-                # find this material in the variant
-                for vm in variant.materials:
-                    if vm.material.cloned_from is not None and vm.material.cloned_from == material:
-                        material = vm.material
-                        break
-                
-                # create a shader for it, and write it
-                shader = export_helper.create_shader_from_material(material)
-                shader.write(file, type)
+                # find this material in the variant, variants that aren't on the scene only have a shader
+                vm = variant.find_material(material)
+                if vm is not None:
+                    shader = vm.get_shader()
+                else:
+                    shader = export_helper.create_shader_from_material(material)
+                shader.write(data, type)
 
-    # write file length
-    shaders_file_length = file.tell() - shaders_data_offset
-    file.seek(shaders_data_offset - 4)
-    file.write(struct.pack('L', shaders_file_length))
-    file.seek(0, 2)
+    bin.write_file(file, "shaders", data.getvalue())
 
 
-def export_geometry(file, meshlist, options):
+def export_geometry(file, meshlist, options, session):
     for obj in meshlist:
-        # write FILE header for mesh name
-        bin.write_file_header(file, helper.get_undupe_name(obj.name))
-        file_data_start_offset = file.tell()
+        # FILE contents are built in memory, so the length is known when it's written
+        data = io.BytesIO()
         
         # don't multiply vertices for objects requring a matrix3x4 export
         premultiply_vertices = not helper.is_matrix_object(obj)
         
-        # create temp mesh
-        temp_mesh = None
-        if "MODIFIERS" in options:
-            dg = bpy.context.evaluated_depsgraph_get()
-            eval_obj = obj.evaluated_get(dg)
-            temp_mesh = eval_obj.to_mesh()
-        else:
-            temp_mesh = obj.to_mesh()
+        # create temp mesh, it's shared by every step of this object
+        temp_mesh = session.evaluate(obj)
     
-        # get bmesh
-        bm = bmesh.new()
-        bm.from_mesh(temp_mesh)
-        bm_tris = bm.calc_loop_triangles()
+        # build the mesh data we need, for all materials in one go
+        matrix = None
+        if premultiply_vertices:
+            matrix = np.array(obj.matrix_world)
+            matrix[:3, 3] -= np.array(obj.location)
+        sections = export_helper.prepare_mesh_data(temp_mesh, matrix)
         
         # get mesh infos
-        export_mats = export_helper.get_used_materials(obj, "MODIFIERS" in options)
-        total_verts = len(bm.verts)
-        total_faces = int(len(bm_tris) * 3)
+        export_mats = export_helper.get_used_materials(obj, temp_mesh)
+        total_verts = len(temp_mesh.vertices)
+        total_faces = int(len(temp_mesh.loop_triangles) * 3)
         num_sections = len(export_mats)
         
         # debug
@@ -339,63 +328,55 @@ def export_geometry(file, meshlist, options):
             export_helper.write_matrix(obj.name, obj, pkg_path)
 
         # write mesh data header
-        file.write(struct.pack('LLLLL', num_sections, total_verts, total_faces, num_sections, FVF_FLAGS.value))
+        data.write(struct.pack('<LLLLL', num_sections, total_verts, total_faces, num_sections, FVF_FLAGS.value))
 
         # write sections
-        cur_material_index = -1
-        for material in obj.data.materials:
+        for cur_material_index, material in enumerate(obj.data.materials):
+            if material is None:
+                continue
+                
             # get non cloned material
             real_material = material
             if material.cloned_from is not None:
                 real_material = material.cloned_from
             
             # are we exporting this material?
-            cur_material_index += 1
             if not real_material in export_mats:
               continue
         
-            # build the mesh data we need
-            cmtl_indices, cmtl_verts, cmtl_uvs, cmtl_cols = export_helper.prepare_mesh_data(bm, cur_material_index, bm_tris)
+            # mesh data of this material, a slot without faces gets an empty strip
+            cmtl_indices, cmtl_positions, cmtl_normals, cmtl_uvs, cmtl_cols = sections.get(cur_material_index, EMPTY_SECTION)
+
+            # indices are written as 16 bit
+            if len(cmtl_positions) > 65535:
+                raise Exception("Object " + obj.name + " has " + str(len(cmtl_positions)) + " vertices using material " + real_material.name +
+                                ", a PKG section can't have more than 65535. Split the object or its material.")
 
             # mesh remap done. we will now write our strip
             num_strips = 1
             section_flags = 0
-            shader_offset = material_remap_table[real_material.name]
+            shader_offset = session.get_material_index(real_material)
             
             # write strip to file
-            file.write(struct.pack('HHL', num_strips, section_flags, shader_offset))
+            data.write(struct.pack('<HHL', num_strips, section_flags, shader_offset))
             strip_primType = 3
-            strip_vertices = len(cmtl_verts)
-            file.write(struct.pack('LL', strip_primType, strip_vertices))
+            strip_vertices = len(cmtl_positions)
+            data.write(struct.pack('<LL', strip_primType, strip_vertices))
             
             # write vertices
-            for cv in range(len(cmtl_verts)):
-                export_vert = cmtl_verts[cv]
-                export_vert_location = ((obj.matrix_world @ export_vert.co) - obj.location) if premultiply_vertices else export_vert.co
-                bin.write_float3(file, helper.convert_vecspace_to_mm2(export_vert_location))
-                if FVF_FLAGS.has_flag("D3DFVF_NORMAL"):
-                    bin.write_float3(file, helper.convert_vecspace_to_mm2(export_vert.normal))
-                if FVF_FLAGS.has_flag("D3DFVF_DIFFUSE"):
-                    bin.write_color4d(file, cmtl_cols[cv])
-                if FVF_FLAGS.has_flag("D3DFVF_SPECULAR"):
-                    bin.write_color4d(file, cmtl_cols[cv])
-                uv_data = cmtl_uvs[cv]
-                bin.write_float2(file, (uv_data[0], (uv_data[1] - 1) * -1))
+            vertex_block = export_helper.get_vertex_block(FVF_FLAGS, cmtl_positions, cmtl_normals, cmtl_uvs, cmtl_cols)
+            data.write(vertex_block.tobytes())
             
             # write indices
             strip_indices_len = int(len(cmtl_indices) * 3)
-            file.write(struct.pack('L', strip_indices_len))
-            for ply in cmtl_indices:
-                file.write(struct.pack('HHH', ply[0], ply[1], ply[2]))
+            data.write(struct.pack('<L', strip_indices_len))
+            data.write(cmtl_indices.astype('<u2').tobytes())
         
         # clean up temp_mesh
-        bm.free()
-		
-        # write FILE length
-        file_data_length = file.tell() - file_data_start_offset
-        file.seek(file_data_start_offset - 4)
-        file.write(struct.pack('L', file_data_length))
-        file.seek(0, 2)
+        session.release()
+        
+        # write FILE
+        bin.write_file(file, helper.get_undupe_name(obj.name), data.getvalue())
 
 
 def export_misc_mtx():
@@ -461,9 +442,10 @@ def save_pkg(filepath,
 
     print('\tPKG autodetected export type: ' + export_typestr)
     
-    # next we need to prepare our material list
+    # next we need to prepare our material list, materials get their index as the geometry uses them
     global material_remap_table
-    material_remap_table = export_helper.create_material_remap(apply_modifiers)
+    session = export_helper.ExportSession(apply_modifiers)
+    material_remap_table = session.material_remap
     
     # finally we need to prepare our geometry list
     export_geomlist = []
@@ -482,7 +464,10 @@ def save_pkg(filepath,
     # begin write pkg file
     file.write(bytes('PKG3', 'utf-8'))
     print('\t[%.4f] exporting mesh data' % (time.perf_counter() - time1))
-    export_geometry(file, reorder_objects(export_geomlist, export_pred), export_options)
+    try:
+        export_geometry(file, reorder_objects(export_geomlist, export_pred), export_options, session)
+    finally:
+        session.release()
     print('\t[%.4f] exporting shaders' % (time.perf_counter() - time1))
     export_shaders(file, context, export_shadertype)
     print('\t[%.4f] exporting xrefs' % (time.perf_counter() - time1))
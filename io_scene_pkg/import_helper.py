@@ -8,11 +8,15 @@
 # ##### END LICENSE BLOCK #####
 
 import bpy, mathutils
-import os, struct
+import os, struct, sys, multiprocessing
 import os.path as path
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import io_scene_pkg.common_helpers as helper
 import io_scene_pkg.binary_helper as bin
+import io_scene_pkg.export_helper as export_helper
+from io_scene_pkg.array_helper import weld_vertices
                        
 #######################
 ### Other Functions ###
@@ -22,203 +26,352 @@ def get_object_name_without_lod_suffix(meshname):
     """Strips off all suffixes for LOD"""
     return meshname.upper().replace("_VL", "").replace("_L", "").replace("_M", "").replace("_H", "")
 
-def find_matrix3x4(meshname, pkg_path):
-    """search for *.mtx and load if found"""
-    pkg_name = os.path.basename(pkg_path)[:-4]
-    search_path = os.path.dirname(pkg_path)
-    mesh_name_parsed = get_object_name_without_lod_suffix(meshname)
+# custom property holding the shader key of imported base materials, so later imports can reuse them
+MATERIAL_KEY_PROPERTY = "pkg_shader_key"
+
+# custom property holding the texture path and shader the material had when it was keyed
+MATERIAL_CHECK_PROPERTY = "pkg_shader_check"
+
+def get_material_check(material):
+    """the texture path and shader of a material. a material whose check changed since
+       it was keyed was edited, and no longer matches its key"""
+    file_path = ""
+    for node in material.node_tree.nodes:
+        if node.type == "TEX_IMAGE" and node.image is not None:
+            file_path = node.image.filepath_raw
+            break
+    return repr((file_path, export_helper.create_shader_from_material(material).key()))
     
-    find_path = helper.find_file_with_game_fallback(pkg_name + "_" + mesh_name_parsed + ".mtx", search_path, "geometry", ignore_subdir_on_search_path=True)
+def set_material_key(material, material_key):
+    material[MATERIAL_KEY_PROPERTY] = material_key
+    material[MATERIAL_CHECK_PROPERTY] = get_material_check(material)
     
-    if find_path is not None:
-        mtxfile = open(find_path, 'rb')
-        return bin.read_matrix3x4(mtxfile)
-    return None
+def clear_material_key(material):
+    """copies keep ID properties, but aren't the material the key was made for"""
+    for prop_name in (MATERIAL_KEY_PROPERTY, MATERIAL_CHECK_PROPERTY):
+        if prop_name in material:
+            del material[prop_name]
+            
+def get_material_key(material):
+    """the key of an imported base material, None if it has none or was edited since"""
+    material_key = material.get(MATERIAL_KEY_PROPERTY)
+    if material_key is None or material.cloned_from is not None or not material.use_nodes:
+        return None
+    if material.get(MATERIAL_CHECK_PROPERTY) != get_material_check(material):
+        return None
+    return material_key
+
+def create_material_template(textured):
+    """a material with the node setup create_material_from_shader copies"""
+    template = bpy.data.materials.new(".PKG Template Textured" if textured else ".PKG Template")
+    helper.create_material_node_setup(template, textured)
+    return template
     
-def find_matrix(meshname, pkg_path):
-    """search for *.mtx and load if found"""
+class ImportCache:
+    """textures, MTX files and materials shared between the PKGs of an import,
+       a batch import only loads each of them once"""
+    def __init__(self):
+        preferences = bpy.context.preferences
+        self.addon_prefs = preferences.addons[__package__].preferences
+        self.texture_cache_settings = helper.get_texture_cache_settings(self.addon_prefs)
+        self.textures = {}
+        self.matrices = {}
+        
+        # materials by their key, including the ones earlier imports made
+        self.materials = {}
+        for material in bpy.data.materials:
+            material_key = get_material_key(material)
+            if material_key is not None:
+                self.materials.setdefault(material_key, material)
+        
+        # node setups copied by populate_material, by whether they're textured
+        self.material_templates = {}
+        
+        # TEX files decoding on worker threads, as (file path, future)
+        self.texture_futures = {}
+        self.texture_pool = None
+        
+        # worker processes decoding geometry, started once for all PKGs
+        self.geometry_pool = None
+        
+    def get_material_template(self, textured):
+        template = self.material_templates.get(textured)
+        if template is None:
+            template = create_material_template(textured)
+            self.material_templates[textured] = template
+        return template
+        
+    def get_texture_pool(self):
+        if self.texture_pool is None:
+            self.texture_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+        return self.texture_pool
+        
+    def close_texture_pool(self):
+        """stop decoding textures nothing asked for"""
+        for file_path, future in self.texture_futures.values():
+            future.cancel()
+        self.texture_futures.clear()
+        
+        if self.texture_pool is not None:
+            self.texture_pool.shutdown()
+            self.texture_pool = None
+            
+    def get_geometry_pool(self, worker_count):
+        """the geometry process pool. it's started with the worker count of the first call"""
+        if self.geometry_pool is None:
+            self.geometry_pool = create_process_pool(worker_count)
+        return self.geometry_pool
+        
+    def close_geometry_pool(self):
+        if self.geometry_pool is not None:
+            self.geometry_pool.shutdown()
+            self.geometry_pool = None
+            
+    def close(self):
+        """done importing, stop the pools and remove the material templates"""
+        self.close_texture_pool()
+        self.close_geometry_pool()
+        for template in self.material_templates.values():
+            bpy.data.materials.remove(template)
+        self.material_templates.clear()
+
+
+# datablock types an import creates, in a safe removal order
+IMPORTED_DATABLOCK_TYPES = ("objects", "meshes", "materials", "images", "collections")
+
+def get_datablock_snapshot():
+    """the existing datablocks, so a cancelled import can remove what it created"""
+    return {data_name: set(getattr(bpy.data, data_name)) for data_name in IMPORTED_DATABLOCK_TYPES}
+    
+def remove_new_datablocks(snapshot):
+    """remove every datablock created since the snapshot was taken"""
+    for data_name in IMPORTED_DATABLOCK_TYPES:
+        data = getattr(bpy.data, data_name)
+        existing = snapshot[data_name]
+        for datablock in [datablock for datablock in data if datablock not in existing]:
+            data.remove(datablock)
+
+
+def prefetch_textures(shader_set, import_variants, pkg_path, cache):
+    """start decoding the textures of a shader set in the background"""
+    variants = shader_set.variants if import_variants else shader_set.variants[:1]
+    texture_names = set(shader.name for variant in variants for shader in variant if shader.name is not None)
+    
+    search_path = get_texture_search_path(pkg_path)
+    for texture_name in sorted(texture_names):
+        helper.prefetch_texture(texture_name, search_path, cache)
+
+
+def read_mtx_file(meshname, pkg_path, cache=None):
+    """search for *.mtx and return its 12 raw floats, or None if it doesn't exist"""
     pkg_name = os.path.basename(pkg_path)[:-4]
     search_path = os.path.dirname(pkg_path)
     mesh_name_parsed = get_object_name_without_lod_suffix(meshname)
+    mtx_name = pkg_name + "_" + mesh_name_parsed + ".mtx"
     
-    find_path = helper.find_file_with_game_fallback(pkg_name + "_" + mesh_name_parsed + ".mtx", search_path, "geometry", ignore_subdir_on_search_path=True)
+    # misses are cached too, most objects don't have an MTX
+    cache_key = (mtx_name.lower(), search_path)
+    if cache is not None and cache_key in cache.matrices:
+        return cache.matrices[cache_key]
     
+    mtx_info = None
+    find_path = helper.find_file_with_game_fallback(mtx_name, search_path, "geometry", ignore_subdir_on_search_path=True)
     if find_path is not None:
-        mtxfile = open(find_path, 'rb')
-        mtx_info = struct.unpack('ffffffffffff', mtxfile.read(48))
-        
+        with open(find_path, 'rb') as mtxfile:
+            mtx_info = bin.unpack(mtxfile, bin.STRUCT_MATRIX3X4)
+    
+    if cache is not None:
+        cache.matrices[cache_key] = mtx_info
+    return mtx_info
+    
+
+def find_matrix3x4(meshname, pkg_path, cache=None):
+    """search for *.mtx and load if found"""
+    mtx_info = read_mtx_file(meshname, pkg_path, cache)
+    if mtx_info is not None:
+        return bin.convert_matrix3x4(mtx_info)
+    return None
+    
+def find_matrix(meshname, pkg_path, cache=None):
+    """search for *.mtx and load if found"""
+    mtx_info = read_mtx_file(meshname, pkg_path, cache)
+    if mtx_info is not None:
         mtx_min = helper.convert_vecspace_to_blender((mtx_info[0], mtx_info[1], mtx_info[2]))
         mtx_max = helper.convert_vecspace_to_blender((mtx_info[3], mtx_info[4], mtx_info[5]))
         pivot =   helper.convert_vecspace_to_blender((mtx_info[6], mtx_info[7], mtx_info[8]))
         origin =  helper.convert_vecspace_to_blender((mtx_info[9], mtx_info[10], mtx_info[11]))
         
-        mtxfile.close()
-        
         return (True, mtx_min, mtx_max, pivot, origin)
     return (False, None, None, None, None)
  
  
-def check_degenerate(i1, i2, i3):
-    if i1 == i2 or i1 == i3 or i2 == i3:
-        return True
-    return False
-    
-def triangle_strip_to_list(strip, clockwise):
-    """convert a strip of triangles into a list of triangles"""
-    triangle_list = []
-    for v in range(len(strip) - 2):
-        if clockwise:
-            triangle_list.extend([strip[v+1], strip[v], strip[v+2]])
-        else:
-            triangle_list.extend([strip[v], strip[v+1], strip[v+2]])
-            
-        # make sure we aren't resetting the clockwise
-        # flag if we have a degenerate triangle
-        if not check_degenerate(strip[v], strip[v+1], strip[v+2]):
-            clockwise = not clockwise
-
-    return triangle_list
-    
-def convert_triangle_strips(tristrip_data):
-    """convert Midnight Club triangle strips into triangle list data"""
-    last_strip_cw = False
-    last_strip_indices = []
-    trilist_data = []
-    for us in tristrip_data:
-        # flags processing
-        FLAG_CW = ((us & (1 << 14)) != 0)
-        FLAG_END = ((us & (1 << 15)) != 0)
-        INDEX = us
-        if FLAG_CW:
-            INDEX &= ~(1 << 14)
-        if FLAG_END:
-            INDEX &= ~(1 << 15)
-            
-        # cw flag is only set at the first index in the strip
-        if len(last_strip_indices) == 0:
-            last_strip_cw = FLAG_CW
-        last_strip_indices.append(INDEX)
-        
-        # are we done with this strip?
-        if FLAG_END:
-            trilist_data.extend(triangle_strip_to_list(last_strip_indices, last_strip_cw))
-            last_strip_cw = False
-            last_strip_indices = []
-    
-    return trilist_data
-
-def read_vertex_data(file, FVF_FLAGS, compressed):
-    """read PKG vertex data into a tuple"""
-    vnorm = mathutils.Vector((1, 1, 1))
-    vuv = (0, 0)
-    vcolor = mathutils.Color((1, 1, 1))
-    if FVF_FLAGS.has_flag("D3DFVF_NORMAL"):
-        vnorm = bin.read_cfloat3(file) if compressed else bin.read_float3(file)
-    if FVF_FLAGS.has_flag("D3DFVF_DIFFUSE"):
-        c4d = bin.read_color4d(file)
-        vcolor = mathutils.Color((c4d[0], c4d[1], c4d[2]))
-    if FVF_FLAGS.has_flag("D3DFVF_SPECULAR"):
-        c4d = bin.read_color4d(file)
-        vcolor = mathutils.Color((c4d[0], c4d[1], c4d[2]))
-    if FVF_FLAGS.has_flag("D3DFVF_TEX1"):
-        vuv = bin.read_cfloat2(file) if compressed else bin.read_float2(file)
+def create_process_pool(worker_count):
+    """create a process pool for decoding work. Workers run without bpy, see pkg_file"""
+    mp_context = multiprocessing.get_context('spawn')
+    
+    # Blender 2.83-2.90 reports its own binary as sys.executable, workers need the bundled python
+    python_path = sys.executable
+    if not path.basename(python_path).lower().startswith("python"):
+        python_path = getattr(bpy.app, "binary_path_python", python_path)
+    mp_context.set_executable(python_path)
+    
+    return ProcessPoolExecutor(max_workers=worker_count, mp_context=mp_context)
+
+def get_blender_vertex_data(geometry):
+    """convert the vertex data of a GeometryData into blender space"""
+    age_vert = helper.convert_vecspace_to_blender_array(geometry.positions)
+    age_norm = helper.convert_vecspace_to_blender_array(geometry.normals)
+    
+    # flip uvs
+    age_uv = geometry.uvs.copy()
+    age_uv[:, 1] = 1 - age_uv[:, 1]
+    
+    # vertex colors. specular takes priority, alpha isn't used
+    vcolor = None
+    vertex_colors = geometry.specular if geometry.specular is not None else geometry.diffuse
+    if vertex_colors is not None:
+        vcolor = vertex_colors.copy()
+        vcolor[:, 3] = 1
           
-    return (vnorm, vuv, vcolor)
+    return (age_vert, age_norm, age_uv, vcolor)
 
-def populate_material(mtl, shader, pkg_path):
-    """ Initializes a material """
-    # get addon settings
-    preferences = bpy.context.preferences
-    addon_prefs = preferences.addons[__package__].preferences    
+def filter_mesh_triangles(triangles):
+    """returns a mask of triangles that are neither degenerate nor duplicates of a previous triangle"""
+    degenerate = ((triangles[:, 0] == triangles[:, 1]) | 
+                  (triangles[:, 0] == triangles[:, 2]) | 
+                  (triangles[:, 1] == triangles[:, 2]))
+    
+    # blender allows only one face per set of vertices, so compare sorted triangles
+    sorted_triangles = np.ascontiguousarray(np.sort(triangles, axis=1))
+    sorted_triangles = sorted_triangles.view(np.dtype((np.void, sorted_triangles.dtype.itemsize * 3))).ravel()
+    unique_index = np.unique(sorted_triangles, return_index=True)[1]
+    
+    mask = np.zeros(len(triangles), dtype=bool)
+    mask[unique_index] = True
+    mask &= ~degenerate
+    return mask
+    
+def build_mesh(me, vertices, vertex_remap, triangles, material_indices, uvs, colors=None):
+    """fill a mesh from flat arrays. triangles index into uvs and colors, vertex_remap maps them to vertices"""
+    loop_triangles = triangles
+    face_triangles = vertex_remap[triangles]
+    
+    mask = filter_mesh_triangles(face_triangles)
+    loop_triangles = loop_triangles[mask]
+    face_triangles = face_triangles[mask]
+    material_indices = material_indices[mask]
     
-    # get tex name
-    texture_name = "age:notexture" if shader.name is None else shader.name
+    num_faces = len(face_triangles)
+    num_loops = num_faces * 3
     
-    # basics
-    mtl.use_nodes = True
-    mtl.use_backface_culling = True
+    # geometry
+    me.vertices.add(len(vertices))
+    me.vertices.foreach_set("co", vertices.ravel())
+    
+    me.loops.add(num_loops)
+    me.loops.foreach_set("vertex_index", face_triangles.ravel())
+    
+    me.polygons.add(num_faces)
+    me.polygons.foreach_set("loop_start", np.arange(0, num_loops, 3, dtype=np.int32))
+    me.polygons.foreach_set("loop_total", np.full(num_faces, 3, dtype=np.int32))
+    me.polygons.foreach_set("material_index", material_indices.astype(np.int32))
+    me.polygons.foreach_set("use_smooth", np.ones(num_faces, dtype=bool))
+    
+    # loop data
+    loop_indices = loop_triangles.ravel()
+    uv_layer = me.uv_layers.new()
+    uv_layer.data.foreach_set("uv", uvs[loop_indices].ravel())
+    
+    vc_layer = me.vertex_colors.new()
+    if colors is not None:
+        vc_layer.data.foreach_set("color", colors[loop_indices].ravel())
+    
+    me.validate()
+    me.update(calc_edges=True)
+
+def get_texture_search_path(pkg_path):
+    return path.abspath(path.join(os.path.dirname(pkg_path), ".."))
+
+def replace_material(old_mtl, new_mtl):
+    """swap every use of a material for another one, and remove the old one"""
+    new_mtl.cloned_from = old_mtl.cloned_from
+    new_mtl.variant = old_mtl.variant
+    old_mtl.user_remap(new_mtl)
+    bpy.data.materials.remove(old_mtl)
+
+def load_shader_texture(shader, pkg_path, cache):
+    """ the texture of a shader, or a placeholder if it's missing and substitution is on. returns (image, is_substituted) """
+    if shader.name is None:
+        return (None, False)
+        
+    tex_result = helper.try_load_texture(shader.name, get_texture_search_path(pkg_path), cache)
+    
+    # debug
+    #if tex_result is not None:
+    #    print("Texture:" + shader.name + ", Path:" + tex_result.filepath_raw)
+        
+    # texture substitution
+    if tex_result is None and cache.addon_prefs.substitute_textures:
+        return (helper.make_placeholder_texture(shader.name), True)
+    return (tex_result, False)
+
+def create_material_from_shader(shader, tex_result, cache, is_substituted_tex=False):
+    """ a new material for a shader, copied from the template node setup """
+    addon_prefs = cache.addon_prefs
+    
+    # copy the node setup, and fill in the shader
+    new_mtl = cache.get_material_template(tex_result is not None).copy()
+    nodes = new_mtl.node_tree.nodes
     
     # setup colors
-    bsdf = mtl.node_tree.nodes["Principled BSDF"]
+    bsdf = nodes["Principled BSDF"]
     bsdf.inputs['Base Color'].default_value = shader.diffuse_color
     bsdf.inputs['Emission'].default_value = shader.emissive_color
     bsdf.inputs['Specular'].default_value = shader.shininess
-    bsdf.inputs['Roughness'].default_value = 0
 
-    mtl.diffuse_color = shader.diffuse_color
-    mtl.specular_intensity = 0.1
-    mtl.metallic = shader.shininess
+    new_mtl.diffuse_color = shader.diffuse_color
+    new_mtl.specular_intensity = 0.1
+    new_mtl.metallic = shader.shininess
 
     # alpha vars
     mtl_alpha = shader.diffuse_color[3]
     tex_depth = 0
-        
-    # look for a texture
-    tex_result = None
-    tex_image_node = None
-    is_substituted_tex = False
-    if shader.name is not None:
-        tex_result = helper.try_load_texture(texture_name, path.abspath(path.join(os.path.dirname(pkg_path), "..")))
-        
-        # debug
-        #if tex_result is not None:
-        #    print("Texture:" + texture_name + ", Path:" + tex_result.filepath_raw)
-            
-        # texture substitution
-        if tex_result is None and addon_prefs.substitute_textures:
-            tex_result = helper.make_placeholder_texture(texture_name)
-            is_substituted_tex = True
-
-    # set up diffuse
+    
+    # set up diffuse, emission and alpha
     if tex_result is not None:
         tex_depth = tex_result.depth
-        tex_image_node = mtl.node_tree.nodes.new('ShaderNodeTexImage')
+        tex_image_node = nodes["Image Texture"]
         tex_image_node.image = tex_result
-        tex_image_node.location = mathutils.Vector((-640.0, 20.0))
         
         # the substitution texture is very low res. Don't filter it.
         if is_substituted_tex:
             tex_image_node.interpolation = "Closest"
             
-        blend_node = mtl.node_tree.nodes.new('ShaderNodeMixRGB')
-        blend_node.inputs['Color2'].default_value = shader.diffuse_color
-        blend_node.inputs['Fac'].default_value = 1.0
-        blend_node.blend_type = 'MULTIPLY'
-        blend_node.label = "Diffuse Color"
-        blend_node.location = mathutils.Vector((-260.0, 160.0))
-        
-        mtl.node_tree.links.new(blend_node.inputs['Color1'], tex_image_node.outputs['Color'])
-        mtl.node_tree.links.new(bsdf.inputs['Base Color'], blend_node.outputs['Color'])
-
-    # setup emission
-    if tex_image_node is not None:
-        blend_node = mtl.node_tree.nodes.new('ShaderNodeMixRGB')
-        blend_node.inputs['Color2'].default_value = shader.emissive_color
-        blend_node.inputs['Fac'].default_value = 1.0
-        blend_node.blend_type = 'MULTIPLY'
-        blend_node.label = "Emission Color"
-        blend_node.location = mathutils.Vector((-260.0, -20.0))
-        
-        mtl.node_tree.links.new(blend_node.inputs['Color1'], tex_image_node.outputs['Color'])
-        mtl.node_tree.links.new(bsdf.inputs['Emission'], blend_node.outputs['Color'])
+        nodes["Diffuse Color"].inputs['Color2'].default_value = shader.diffuse_color
+        nodes["Emission Color"].inputs['Color2'].default_value = shader.emissive_color
+        nodes["Alpha"].inputs[0].default_value = mtl_alpha
+    else:
+        bsdf.inputs['Alpha'].default_value = mtl_alpha
      
     # have alpha?
     if mtl_alpha < 1 or tex_depth == 32:
-        mtl.blend_method = 'HASHED' if addon_prefs.use_alpha_hash else 'BLEND'
-        
-    # assign transparent channel on BSDF
-    if tex_image_node is not None:
-        blend_node = mtl.node_tree.nodes.new('ShaderNodeMath')
-        blend_node.inputs[0].default_value = mtl_alpha
-        blend_node.operation = 'MULTIPLY'
-        blend_node.label = "Alpha"
-        blend_node.location = mathutils.Vector((-260.0, -200.0))
-        
-        mtl.node_tree.links.new(blend_node.inputs[1], tex_image_node.outputs['Alpha'])
-        mtl.node_tree.links.new(bsdf.inputs['Alpha'], blend_node.outputs[0])
-    else:
-        bsdf.inputs['Alpha'].default_value = mtl_alpha
+        new_mtl.blend_method = 'HASHED' if addon_prefs.use_alpha_hash else 'BLEND'
         
-    mtl.name = texture_name
-
-        
\ No newline at end of file
+    new_mtl.name = "age:notexture" if shader.name is None else shader.name
+    return new_mtl
+    
+def populate_material(mtl, shader, pkg_path, cache=None):
+    """ Initializes a material. mtl is replaced by a copy of a template material, which is returned """
+    if cache is None:
+        cache = ImportCache()
+        try:
+            return populate_material(mtl, shader, pkg_path, cache)
+        finally:
+            cache.close()
+    
+    tex_result, is_substituted_tex = load_shader_texture(shader, pkg_path, cache)
+    new_mtl = create_material_from_shader(shader, tex_result, cache, is_substituted_tex)
+    
+    replace_material(mtl, new_mtl)
+    new_mtl.name = "age:notexture" if shader.name is None else shader.name
+    return new_mtl
@@ -7,19 +7,21 @@
 #
 # ##### END LICENSE BLOCK #####
 
-import bpy, bmesh, mathutils
-import os, time, struct, math
+import bpy, mathutils
+import os, time, struct, math, fnmatch
 
 import os.path as path
 from mathutils import*
-from io_scene_pkg.fvf import FVF
-from io_scene_pkg.shader_set import (ShaderSet, Shader)
+from io_scene_pkg.pkg_file import (PKGFile, read_geometry_at)
 
 import io_scene_pkg.binary_helper as bin
 import io_scene_pkg.import_helper as import_helper
 import io_scene_pkg.common_helpers as helper
+import io_scene_pkg.texture_cache as texture_cache
 
 pkg_path = None
+import_collection = None
+import_cache = None
 
 ######################################################
 # GLOBAL LISTS
@@ -32,14 +34,11 @@ misc_mtx_objects = ["EXHAUST0", "EXHAUST1"]
 ######################################################
 # IMPORT MAIN FILES
 ######################################################
-def read_shaders_file(file, length, offset, import_variants):
+def read_shaders_file(shader_set, import_variants):
     # get custom stuff
     scene = bpy.context.scene
     angel = scene.angel
     
-    # read shader set
-    shader_set = ShaderSet(file)
-    
     num_variants = len(shader_set.variants)
     if num_variants <= 0:
         return
@@ -49,15 +48,34 @@ def read_shaders_file(file, length, offset, import_variants):
     # setup base material set
     base_material_set = []
     base_variant = shader_set.variants[0]
+    texture_search_path = import_helper.get_texture_search_path(pkg_path)
     for shader_num in range(num_shaders_per_variant):
         shader = base_variant[shader_num]
         
         mtl = bpy.data.materials.get(str(shader_num))
-        if mtl is not None:
-            import_helper.populate_material(mtl, shader, pkg_path)
-            base_material_set.append(mtl)
+        if mtl is None:
+            base_material_set.append(None) # only happens if the geometry using it was filtered out
+            continue
+        
+        # identical shaders share one material, also across the PKGs of a batch import.
+        # with variants, a shader is only identical if it is in every variant
+        if import_variants:
+            shader_key = tuple(variant[shader_num].key() for variant in shader_set.variants)
         else:
-            base_material_set.append(None) # SHOULD NOT HAPPEN!
+            shader_key = (shader.key(),)
+        material_key = repr((texture_search_path, shader_key))
+        
+        # materials from earlier imports are found by the key stored on them
+        cached_mtl = import_cache.materials.get(material_key)
+        if cached_mtl is not None:
+            mtl.user_remap(cached_mtl)
+            bpy.data.materials.remove(mtl)
+            mtl = cached_mtl
+        else:
+            mtl = import_helper.populate_material(mtl, shader, pkg_path, import_cache)
+            import_helper.set_material_key(mtl, material_key)
+            import_cache.materials[material_key] = mtl
+        base_material_set.append(mtl)
     
     # don't set up variants if the import flag isn't set 
     if not import_variants:
@@ -66,250 +84,172 @@ def read_shaders_file(file, length, offset, import_variants):
     # clear existing variant stuff
     angel.clear()
     
+    # shader keys are compared instead of the shaders themselves
+    variant_keys = [[shader.key() for shader in variant] for variant in shader_set.variants]
+    
     # find what materials are equal across the board
     # this will give us the ability of quickly checking if variants are unique
     # but also a reference point for variant 0
     variant_similarities = [0] * num_shaders_per_variant
     for i in range(num_variants - 1, 0, -1):
-        variant_ref = shader_set.variants[i]
-        variant_prev = shader_set.variants[i-1]
+        variant_ref = variant_keys[i]
+        variant_prev = variant_keys[i-1]
         for j in range(num_shaders_per_variant):
             if variant_ref[j] == variant_prev[j]:
                 variant_similarities[j] += 1
    
-    # setup variants
+    # setup variants. only the shaders are stored, materials are made for the variant on the scene
     for variant_num  in range(num_variants):
         tool_variant = angel.variants.add() # add to our tool
         variant = shader_set.variants[variant_num]
         for shader_num in range(num_shaders_per_variant):
             shader = variant[shader_num]
+            shader_key = variant_keys[variant_num][shader_num]
             
             # check if this shader is unique to this variant
             if variant_similarities[shader_num] == num_variants - 1:
                 continue
-            elif variant_num > 0 and shader == base_variant[shader_num]:
+            elif variant_num > 0 and shader_key == variant_keys[0][shader_num]:
                 continue
 
-            # get shader base material
+            # get shader base material, it won't exist if no imported geometry uses it
             base_mtl = base_material_set[shader_num]
+            if base_mtl is None:
+                continue
             
-            # add the base material to the variant, returning the cloned, variant version
-            variant_material = tool_variant.add_material(base_mtl)
-            
-            # adjust the cloned version
-            import_helper.populate_material(variant_material.material, shader, pkg_path)
-            variant_material.material.name = helper.get_undupe_name(variant_material.material.name) + "_VARIANT" + str(variant_num)
+            # add the shader to the variant, with its texture so it doesn't have to be searched for again
+            texture, is_substituted_tex = import_helper.load_shader_texture(shader, pkg_path, import_cache)
+            tool_variant.add_shader(base_mtl, shader, texture)
             
     # apply it 
     angel.apply_to_scene()
     angel.selected_variant = 0
-    
-    # skip to the end of this FILE
-    file.seek(length - (file.tell() - offset), 1)
     return
 
 
-def read_xrefs(file):
-    scn = bpy.context.scene
-
-    # read xrefs
-    num_xrefs = struct.unpack('L', file.read(4))[0]
-    for num in range(num_xrefs):
-        # read matrix
-        mtx = bin.read_matrix3x4(file)
-
-        # read in xref name, and remove junk Angel Studios didn't null
-        xref_name_bytes = bytearray(file.read(32))
-        for b in range(len(xref_name_bytes)):
-          if xref_name_bytes[b] > 126:
-            xref_name_bytes[b] = 0
-        
+def read_xrefs(xrefs):
+    for xref in xrefs:
         # setup object
-        xref_name = xref_name_bytes.decode("utf-8")
-        ob = bpy.data.objects.new("xref:" + xref_name, None)
+        ob = bpy.data.objects.new("xref:" + xref.name, None)
         
         # set matrix
-        ob.matrix_basis = mtx
+        ob.matrix_basis = bin.convert_matrix3x4(xref.matrix)
         
         ob.show_name = True
         ob.show_axis = True
-        scn.collection.objects.link(ob)
-
+        import_collection.objects.link(ob)
 
-def read_geometry_file(file, meshname):
-    scn = bpy.context.scene
 
+def read_geometry_file(geometry, meshname, weld_tolerance=0.0):
     # add a mesh and link it to the scene
     me = bpy.data.meshes.new(meshname+'Mesh')
     ob = bpy.data.objects.new(meshname, me)
-
-    bm = bmesh.new()
-    bm.from_mesh(me)
-    bm.verts.ensure_lookup_table()
-    
-    # create layers for this object
-    uv_layer = bm.loops.layers.uv.new()
-    vc_layer = bm.loops.layers.color.new()
-    
-    # link to scene
-    scn.collection.objects.link(ob)
-    bpy.context.view_layer.objects.active = ob
-    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-    
-    # read geometry FILE data
-    num_sections, num_vertices_tot, num_indices_tot, num_sections_dupe, fvf = struct.unpack('5L', file.read(20))
-    FVF_FLAGS = FVF(fvf)
-
-    # mesh data holders
-    ob_current_material = -1
-
-    vertex_remap_table = {}
-    vertex_index_remap = {}
-    mesh_vertices = []
-    mesh_uvs = []
-    mesh_colors = []
+    import_collection.objects.link(ob)
     
-    index_offset = 0
-    
-    # read sections
-    for num in range(num_sections):
-        num_strips, strip_flags = struct.unpack('<HH', file.read(4))
-        
-        # check section strip flag
-        FLAG_compact_strips = ((strip_flags & (1 << 8)) != 0)
-
-        # get material, and add it to the objects material list
-        shader_offset = struct.unpack('H', file.read(2))[0] if FLAG_compact_strips else struct.unpack('L', file.read(4))[0]
-        
+    # add materials for each section
+    for shader_offset in geometry.shader_offsets:
         # do we have this material?
         if bpy.data.materials.get(str(shader_offset)) is None:
             # we must make it!
             bpy.data.materials.new(name=str(shader_offset))
         
         ob.data.materials.append(bpy.data.materials.get(str(shader_offset)))
-        ob_current_material += 1
-        
-        # read strips
-        for strip in range(num_strips):
-            # read
-            prim_type = struct.unpack('H', file.read(2))[0] if FLAG_compact_strips else struct.unpack('L', file.read(4))[0] # seek past primtype
-            num_vertices =  struct.unpack('H', file.read(2))[0] if FLAG_compact_strips else struct.unpack('L', file.read(4))[0]
-
-            # read vertices
-            for i in range(num_vertices):
-                # read in raw data
-                vpos = bin.read_float3(file)
-                vnorm, vuv, vcolor = import_helper.read_vertex_data(file, FVF_FLAGS, FLAG_compact_strips)
-               
-                # convert coordinate spaces
-                age_norm = helper.convert_vecspace_to_blender(vnorm)
-                age_vert = helper.convert_vecspace_to_blender(vpos)
-                age_uv = (vuv[0], (vuv[1] * -1) + 1)
-                
-                # add to uvs and colors list
-                mesh_uvs.append(age_uv)
-                mesh_colors.append(vcolor)
-                
-                # add vertex to mesh or remap
-                pos_hash = str(age_vert)
-                nrm_hash = str(age_norm)
-                vertex_hash = pos_hash + "|" + nrm_hash
-                
-                if vertex_hash in vertex_remap_table:
-                    vertex_index_remap[i+index_offset] = vertex_remap_table[vertex_hash]
-                else:
-                    # add vertex to mesh
-                    bmvert = bm.verts.new(age_vert)
-                    bmvert.normal = age_norm
-               
-                    vertex_remap_table[vertex_hash] = len(mesh_vertices)
-                    vertex_index_remap[i+index_offset] = len(mesh_vertices)
-                    
-                    mesh_vertices.append(bmvert)
-                    
-                    
-            # read indices and build mesh
-            num_indices = struct.unpack('H', file.read(2))[0] if FLAG_compact_strips else struct.unpack('L', file.read(4))[0]
-
-            triangle_data = None
-            if FLAG_compact_strips and prim_type == 4:
-             tristrip_data = struct.unpack(str(num_indices) + 'H', file.read(2 * num_indices))
-             triangle_data = import_helper.convert_triangle_strips(tristrip_data)
-            else:
-             triangle_data = struct.unpack(str(num_indices) + 'H', file.read(2 * num_indices))
-
-            for i in range(0, len(triangle_data), 3):
-              tri_indices = triangle_data[i:i+3]
-              try:
-                  # get verts
-                  v0 = mesh_vertices[vertex_index_remap[tri_indices[0]+index_offset]]
-                  v1 = mesh_vertices[vertex_index_remap[tri_indices[1]+index_offset]]
-                  v2 = mesh_vertices[vertex_index_remap[tri_indices[2]+index_offset]]
-                  
-                  # setup face
-                  face = bm.faces.new((v0, v1, v2))
-                  face.smooth = True
-                  face.material_index = ob_current_material
-                  
-                  # set uvs
-                  for uv_set_loop in range(3):
-                    face.loops[uv_set_loop][uv_layer].uv = mesh_uvs[tri_indices[uv_set_loop] + index_offset]
-                    
-                  # set colors
-                  if FVF_FLAGS.has_flag("D3DFVF_DIFFUSE") or FVF_FLAGS.has_flag("D3DFVF_SPECULAR"):
-                      for color_set_loop in range(3):
-                        face.loops[color_set_loop][vc_layer] = mesh_colors[tri_indices[color_set_loop] + index_offset]
-                    
-              except Exception as e:
-                  print(str(e))
-            
-            index_offset += num_vertices
-
-    # apply bmesh data to object
-    bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
-    bm.to_mesh(me)
-    bm.free()
     
-    # calculate normals
-    if FVF_FLAGS.has_flag("D3DFVF_NORMAL"):
-      me.calc_normals()
+    # weld vertices and build the mesh in one go
+    if geometry.num_triangles > 0:
+        age_verts, age_norms, age_uvs, vcolors = import_helper.get_blender_vertex_data(geometry)
+        welded_indices, vertex_index_remap = import_helper.weld_vertices(age_verts, age_norms, weld_tolerance)
+        
+        import_helper.build_mesh(me,
+                                 age_verts[welded_indices],
+                                 vertex_index_remap,
+                                 geometry.triangles,
+                                 geometry.material_indices,
+                                 age_uvs,
+                                 vcolors)
+    elif geometry.num_vertices > 0:
+        # no faces, keep the vertices as loose points
+        age_verts = helper.convert_vecspace_to_blender_array(geometry.positions)
+        age_norms = helper.convert_vecspace_to_blender_array(geometry.normals)
+        welded_indices, vertex_index_remap = import_helper.weld_vertices(age_verts, age_norms, weld_tolerance)
+        
+        me.vertices.add(len(welded_indices))
+        me.vertices.foreach_set("co", age_verts[welded_indices].ravel())
+        me.update()
 
     # lastly, look for a MTX file. Don't grab an MTX for FNDR_M/L/VL though
     # as the FNDR lods are static and don't use the mtx
     if not ("fndr" in meshname.lower() and not "_h" in meshname.lower()):
       if helper.is_matrix_object(ob):
         # some objects actually use MTX as a matrix.
-        mtx = import_helper.find_matrix3x4(meshname, pkg_path)
+        mtx = import_helper.find_matrix3x4(meshname, pkg_path, import_cache)
         if mtx is not None:
             ob.matrix_world = mtx
       else:
         # others use it as min,max,pivot,origin
-        found, min, max, pivot, origin = import_helper.find_matrix(meshname, pkg_path)
+        found, min, max, pivot, origin = import_helper.find_matrix(meshname, pkg_path, import_cache)
         if found:
             ob.location = origin
           
     return
 
+def is_geometry_selected(name, import_lods, include_patterns, exclude_patterns):
+    """check a geometry FILE name against the LOD and name filters"""
+    lod = helper.get_object_lod_name(name)
+    if lod is not None and lod not in import_lods:
+        return False
+    
+    name_upper = name.upper()
+    if len(include_patterns) > 0 and not any(fnmatch.fnmatchcase(name_upper, pattern) for pattern in include_patterns):
+        return False
+    if any(fnmatch.fnmatchcase(name_upper, pattern) for pattern in exclude_patterns):
+        return False
+    return True
+    
+def parse_name_patterns(patterns):
+    return [pattern.strip().upper() for pattern in patterns.split(",") if len(pattern.strip()) > 0]
+
 def import_misc_mtx():
-    scn = bpy.context.scene
     for mtx in misc_mtx_objects:
-        found, min, max, pivot, origin = import_helper.find_matrix(mtx, pkg_path)
+        found, min, max, pivot, origin = import_helper.find_matrix(mtx, pkg_path, import_cache)
         if found:
             ob = bpy.data.objects.new(mtx, None)
             ob.location = origin
             ob.empty_display_size = 0.5
             ob.show_name = True
-            scn.collection.objects.link(ob)
+            import_collection.objects.link(ob)
         
 ######################################################
 # IMPORT
 ######################################################
-def load_pkg(filepath,
-             context,
-             import_variants=True):
+def load_pkg_iter(filepath,
+                  context,
+                  import_variants=True,
+                  weld_tolerance=0.0,
+                  import_lods=('H', 'M', 'L', 'VL'),
+                  include_patterns="",
+                  exclude_patterns="",
+                  use_multiprocessing=False,
+                  worker_count=0,
+                  collection=None,
+                  cache=None):
+    """import a PKG one FILE at a time. yields (FILEs done, FILE count) after every FILE,
+       returns whether the PKG could be read"""
     # set the PKG path, used for finding textures
     global pkg_path
     pkg_path = filepath
+    
+    # objects go to the scene collection unless a collection is given
+    global import_collection
+    import_collection = collection if collection is not None else context.scene.collection
+    
+    # a batch import shares one cache between all of its PKGs
+    global import_cache
+    owns_cache = cache is None
+    if owns_cache:
+        # files may have been added since the last import, in the same mtime tick as the listing
+        helper.clear_directory_listings()
+    import_cache = cache if cache is not None else import_helper.ImportCache()
 
     # start import
     print("importing PKG: %r..." % (filepath))
@@ -318,61 +258,70 @@ def load_pkg(filepath,
         bpy.ops.object.select_all(action='DESELECT')
 
     time1 = time.perf_counter()
-    file = open(filepath, 'rb')
-
-    # start reading our pkg file
-    pkg_version = file.read(4).decode("utf-8")
-    if pkg_version != "PKG3" and pkg_version != "PKG2":
-        print('\tFatal Error: PKG file is wrong format : ' + pkg_version)
-        file.close()
-        return
-        
-    pkg_version_id = int(pkg_version[-1:])
-
-    # read pkg FILE's
-    pkg_size = path.getsize(filepath)
-    while file.tell() != pkg_size:
-        file_header = None
-        try:
-          file_header = file.read(4).decode("utf-8")
-        except Exception as e:
-          print("cannot decode file header @ " + str(file.tell()))
-          print(str(e))
-          file.close()
-          raise
-
-        # check for an invalid header
-        if file_header != "FILE":
-            print('\tFatal Error: PKG file is corrupt, missing FILE header at ' + str(file.tell()))
-            file.close()
-            return
-
-        # found a proper FILE header
-        file_name = bin.read_angel_string(file)
-        file_length = 0 if pkg_version_id == 2 else struct.unpack('L', file.read(4))[0]
+    texture_cache_counters = texture_cache.get_counters()
+    try:
+        pkg = PKGFile(filepath)
+    except Exception as e:
+        print('\tFatal Error: ' + str(e))
+        return False
+
+    include_patterns = parse_name_patterns(include_patterns)
+    exclude_patterns = parse_name_patterns(exclude_patterns)
+    
+    # unselected geometry is never decoded
+    skipped_entries = {entry for entry in pkg.entries 
+                       if entry.type == "geometry" and not is_geometry_selected(entry.name, import_lods, include_patterns, exclude_patterns)}
+    geometry_entries = [entry for entry in pkg.entries if entry.type == "geometry" and entry not in skipped_entries]
+    
+    # decode geometry in worker processes, meshes are still built here.
+    # a batch import starts the processes once, a single PKG only needs one per FILE
+    geometry_futures = {}
+    if use_multiprocessing and len(geometry_entries) > 1:
+        pool_size = worker_count if worker_count > 0 else os.cpu_count() or 1
+        if owns_cache:
+            pool_size = min(pool_size, len(geometry_entries))
+        geometry_pool = import_cache.get_geometry_pool(pool_size)
+        for entry in geometry_entries:
+            geometry_futures[entry] = geometry_pool.submit(read_geometry_at, filepath, entry.offset)
+
+    # read pkg FILE's. the finally also runs when a modal import is cancelled 
+    # and closes this generator
+    try:
+        # the shaders FILE comes last, read it first so textures decode while geometry is built
+        shaders_entry = next((entry for entry in pkg.entries if entry.type == "shaders"), None)
+        if shaders_entry is not None:
+            import_helper.prefetch_textures(shaders_entry.data, import_variants, filepath, import_cache)
         
-        # Angel released a very small batch of corrupt PKG files
-        # this is here just in case someone tries to import one
-        if file_length == 0 and pkg_version_id == 3:
-            print("Invalid PKG3 file : cannot have file length of 0")
-            file.close()
-            return
-            
-        print('\t[' + str(round(time.perf_counter() - time1, 3)) + '] processing : ' + file_name)
-        if file_name == "shaders":
-            # load shaders file
-            read_shaders_file(file, file_length, file.tell(), import_variants)
-        elif file_name == "offset":
-            # skip over this, seems it's meta
-            if pkg_version_id == 3:
-               file.seek(file_length, 1)
+        num_entries = len(pkg.entries)
+        for entry_num, entry in enumerate(pkg.entries):
+            if entry in skipped_entries:
+                print('\t[' + str(round(time.perf_counter() - time1, 3)) + '] skipping : ' + entry.name)
+                yield (entry_num + 1, num_entries)
+                continue
+                
+            print('\t[' + str(round(time.perf_counter() - time1, 3)) + '] processing : ' + entry.name)
+            if entry.type == "shaders":
+                # load shaders file
+                read_shaders_file(entry.data, import_variants)
+            elif entry.type == "offset":
+                # skip over this, seems it's meta
+                pass
+            elif entry.type == "xrefs":
+                read_xrefs(entry.data)
+            elif entry in geometry_futures:
+                read_geometry_file(geometry_futures.pop(entry).result(), entry.name, weld_tolerance)
             else:
-              file.seek(12, 1)
-        elif file_name == "xrefs":
-            read_xrefs(file)
+                # geometry isn't kept around on the entry once it's built
+                read_geometry_file(pkg.read_entry(entry), entry.name, weld_tolerance)
+            yield (entry_num + 1, num_entries)
+    finally:
+        for future in geometry_futures.values():
+            future.cancel()
+        if owns_cache:
+            import_cache.close()
         else:
-            # assume geometry
-            read_geometry_file(file, file_name)
+            import_cache.close_texture_pool()
+        pkg.close()
     # END READ PKG FILE DATA
     
     # READ MISC MTX
@@ -380,18 +329,133 @@ def load_pkg(filepath,
     # END READ MISC MTX
     
     print(" done in %.4f sec." % (time.perf_counter() - time1))
-    file.close()
+    if import_cache.texture_cache_settings is not None:
+        hits, misses = texture_cache.get_counters()
+        print(" texture cache: %d hits, %d misses" % (hits - texture_cache_counters[0], misses - texture_cache_counters[1]))
+    return True
+
+
+def load_pkg(filepath,
+             context,
+             import_variants=True,
+             weld_tolerance=0.0,
+             import_lods=('H', 'M', 'L', 'VL'),
+             include_patterns="",
+             exclude_patterns="",
+             use_multiprocessing=False,
+             worker_count=0,
+             collection=None,
+             cache=None):
+    """import a PKG in one go"""
+    steps = load_pkg_iter(filepath,
+                          context,
+                          import_variants,
+                          weld_tolerance,
+                          import_lods,
+                          include_patterns,
+                          exclude_patterns,
+                          use_multiprocessing,
+                          worker_count,
+                          collection,
+                          cache
+                          )
+    while True:
+        try:
+            next(steps)
+        except StopIteration as result:
+            return result.value
 
 
 def load(operator,
          context,
          filepath="",
-         import_variants=True
+         import_variants=True,
+         weld_tolerance=0.0,
+         import_lods=('H', 'M', 'L', 'VL'),
+         include_patterns="",
+         exclude_patterns="",
+         use_multiprocessing=False,
+         worker_count=0
          ):
          
     load_pkg(filepath,
              context,
-             import_variants
+             import_variants,
+             weld_tolerance,
+             import_lods,
+             include_patterns,
+             exclude_patterns,
+             use_multiprocessing,
+             worker_count
              )
 
     return {'FINISHED'}
+
+
+def load_batch(operator,
+               context,
+               filepaths=(),
+               weld_tolerance=0.0,
+               import_lods=('H', 'M', 'L', 'VL'),
+               include_patterns="",
+               exclude_patterns="",
+               use_multiprocessing=False,
+               worker_count=0
+               ):
+    # textures, MTX files and materials are shared by the whole batch. 
+    # directories are listed again once for it
+    helper.clear_directory_listings()
+    cache = import_helper.ImportCache()
+    texture_cache_counters = texture_cache.get_counters()
+    timings = []
+    
+    time1 = time.perf_counter()
+    try:
+        for filepath in filepaths:
+            # each PKG gets its own collection
+            collection = bpy.data.collections.new(os.path.splitext(os.path.basename(filepath))[0])
+            context.scene.collection.children.link(collection)
+            
+            time2 = time.perf_counter()
+            # variants are scene wide, a batch doesn't import them
+            success = load_pkg(filepath,
+                               context,
+                               False,
+                               weld_tolerance,
+                               import_lods,
+                               include_patterns,
+                               exclude_patterns,
+                               use_multiprocessing,
+                               worker_count,
+                               collection,
+                               cache
+                               )
+            timings.append((filepath, time.perf_counter() - time2, success))
+            
+            if not success:
+                bpy.data.collections.remove(collection)
+    finally:
+        cache.close()
+    
+    # summary
+    total_time = time.perf_counter() - time1
+    num_failed = sum(1 for timing in timings if not timing[2])
+    
+    print("batch import summary:")
+    for filepath, file_time, success in timings:
+        print("\t%.4f sec. : %s%s" % (file_time, os.path.basename(filepath), "" if success else " (FAILED)"))
+    print("\t%d files, %d textures, %d materials in %.4f sec." % (len(timings), 
+                                                                 sum(1 for image in cache.textures.values() if image is not None),
+                                                                 len(cache.materials),
+                                                                 total_time))
+    if cache.texture_cache_settings is not None:
+        hits, misses = texture_cache.get_counters()
+        print("\ttexture cache: %d hits, %d misses" % (hits - texture_cache_counters[0], misses - texture_cache_counters[1]))
+    
+    message = "Imported %d PKG files in %.2f sec." % (len(timings) - num_failed, total_time)
+    if num_failed > 0:
+        operator.report({'WARNING'}, message + " %d failed, see the console for details" % num_failed)
+    else:
+        operator.report({'INFO'}, message)
+    
+    return {'FINISHED'}
@@ -47,6 +47,70 @@ class ImportTEX(bpy.types.Operator, ImportHelper):
         
         return {'FINISHED'}
 
+class ExportTEX(bpy.types.Operator, ExportHelper):
+    """Export an image to Angel Studios TEX file format"""
+    bl_idname = "export_texture.tex"
+    bl_label = 'Export TEX Image'
+
+    filename_ext = ".tex"
+    filter_glob: StringProperty(default="*.tex", options={'HIDDEN'})
+    
+    image_name: StringProperty(
+        name="Image",
+        description="Image to export",
+        )
+        
+    tex_format: EnumProperty(
+        name="Format",
+        items=(('P8', "P8", "256 color palette"),
+               ('PA8', "PA8", "256 color palette with alpha"),
+               ('P8A8', "P8A8", "256 color palette with a separate alpha channel"),
+               ('P4', "P4", "16 color palette"),
+               ('PA4', "PA4", "16 color palette with alpha"),
+               ('A1R5G5B5', "A1R5G5B5", "16 bit color with 1 bit alpha"),
+               ('RGB888', "RGB888", "24 bit color"),
+               ('RGB8888', "RGB8888", "32 bit color with alpha")),
+        default='P8',
+        )
+        
+    generate_mips: BoolProperty(
+        name="Mipmaps",
+        description="Generate box filtered mipmaps",
+        default=True,
+        )
+        
+    def invoke(self, context, event):
+        if self.image_name == "" and context.space_data is not None and context.space_data.type == 'IMAGE_EDITOR' and context.space_data.image is not None:
+            self.image_name = context.space_data.image.name
+        return ExportHelper.invoke(self, context, event)
+        
+    def draw(self, context):
+        layout = self.layout
+        layout.prop_search(self, "image_name", bpy.data, "images")
+        layout.prop(self, "tex_format")
+        layout.prop(self, "generate_mips")
+        
+    def execute(self, context):
+        from io_scene_pkg.tex_file import (TEXFile, TEXType)
+        image = bpy.data.images.get(self.image_name)
+        if image is None:
+            self.report({'ERROR'}, "Choose an image to export")
+            return {'CANCELLED'}
+        if image.size[0] == 0 or image.size[1] == 0:
+            self.report({'ERROR'}, "Image " + image.name + " has no pixel data")
+            return {'CANCELLED'}
+            
+        if self.tex_format in ('P4', 'PA4') and (image.size[0] * image.size[1]) % 2 != 0:
+            self.report({'ERROR'}, "P4 and PA4 textures need an even number of pixels")
+            return {'CANCELLED'}
+            
+        tex = TEXFile()
+        tex.from_blender_image(image, TEXType[self.tex_format], self.generate_mips)
+        tex.write(self.properties.filepath)
+        
+        return {'FINISHED'}
+        
+
 class ImportTEXMenu(bpy.types.Menu):
     bl_idname = "ANGEL_MT_import_tex_menu"
     bl_label = "Angel Tools"
@@ -55,6 +119,7 @@ class ImportTEXMenu(bpy.types.Menu):
         layout = self.layout
 
         layout.operator("import_texture.tex")
+        layout.operator("export_texture.tex")
         
     def menu_draw(self, context):
         self.layout.menu("ANGEL_MT_import_tex_menu")
@@ -63,10 +128,12 @@ class ImportTEXMenu(bpy.types.Menu):
 def register():
     bpy.utils.register_class(ImportTEXMenu)
     bpy.utils.register_class(ImportTEX)
+    bpy.utils.register_class(ExportTEX)
     bpy.types.TOPBAR_MT_editor_menus.append(ImportTEXMenu.menu_draw)
 
 
 def unregister():
     bpy.types.TOPBAR_MT_editor_menus.remove(ImportTEXMenu.menu_draw)
+    bpy.utils.unregister_class(ExportTEX)
     bpy.utils.unregister_class(ImportTEX)
     bpy.utils.unregister_class(ImportTEXMenu)
\ No newline at end of file
@@ -8,6 +8,7 @@
 # ##### END LICENSE BLOCK #####
 
 import bpy, mathutils
+import io_scene_pkg.common_helpers as helper
 
 from bpy.types import (Panel,
                        Menu,
@@ -36,11 +37,6 @@ class CreateMaterialSetupOperator(Operator):
     def execute(self, context):
         scene = context.scene
         
-        # TODO?
-        # Move most of this into common_helpers, and use it to setup a base for import_helpers
-        # then assign values by getting nodes by name. Currently this is essentially just a huge
-        # copy paste from import_helpers
-        
         # get active material
         ob = context.active_object
         material = ob.active_material
@@ -57,53 +53,8 @@ class CreateMaterialSetupOperator(Operator):
             self.report({'ERROR'}, "This material has been modified. This operation only works on brand new materials.")
             return {'CANCELLED'}
             
-        # basics
-        material.use_backface_culling = True
-    
-        # continuing on, we start making the node setup now
-        bsdf = material.node_tree.nodes["Principled BSDF"]
-        
-        bsdf.inputs['Emission'].default_value = (0, 0, 0, 1)
-        bsdf.inputs['Specular'].default_value = 0.0
-        bsdf.inputs['Roughness'].default_value = 0
-        
-        # create image node
-        tex_image_node = material.node_tree.nodes.new('ShaderNodeTexImage')
-        tex_image_node.location = mathutils.Vector((-640.0, 20.0))
-        
-        # create diffuse blend node
-        blend_node = material.node_tree.nodes.new('ShaderNodeMixRGB')
-        blend_node.inputs['Color2'].default_value = (1, 1, 1, 1)
-        blend_node.inputs['Fac'].default_value = 1.0
-        blend_node.blend_type = 'MULTIPLY'
-        blend_node.label = "Diffuse Color"
-        blend_node.location = mathutils.Vector((-260.0, 160.0))
-        
-        # hook up diffuse
-        material.node_tree.links.new(blend_node.inputs['Color1'], tex_image_node.outputs['Color'])
-        material.node_tree.links.new(bsdf.inputs['Base Color'], blend_node.outputs['Color'])
-        
-        # create emissive blend node
-        blend_node = material.node_tree.nodes.new('ShaderNodeMixRGB')
-        blend_node.inputs['Color2'].default_value = (0, 0, 0, 1)
-        blend_node.inputs['Fac'].default_value = 1.0
-        blend_node.blend_type = 'MULTIPLY'
-        blend_node.label = "Emission Color"
-        blend_node.location = mathutils.Vector((-260.0, -20.0))
-        
-        material.node_tree.links.new(blend_node.inputs['Color1'], tex_image_node.outputs['Color'])
-        material.node_tree.links.new(bsdf.inputs['Emission'], blend_node.outputs['Color'])
-        
-        # create the alpha blend node
-        blend_node = material.node_tree.nodes.new('ShaderNodeMath')
-        blend_node.inputs[0].default_value = 1.0
-        blend_node.operation = 'MULTIPLY'
-        blend_node.label = "Alpha"
-        blend_node.location = mathutils.Vector((-260.0, -200.0))
-        
-        material.node_tree.links.new(blend_node.inputs[1], tex_image_node.outputs['Alpha'])
-        material.node_tree.links.new(bsdf.inputs['Alpha'], blend_node.outputs[0])
-        
+        # same node setup the importer uses
+        helper.create_material_node_setup(material)
         
         return {'FINISHED'}
         
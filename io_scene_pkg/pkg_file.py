@@ -0,0 +1,372 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Created by Dummiesman, 2016-2020
+#
+# ##### END LICENSE BLOCK #####
+
+# PKG file model. This module does not depend on bpy, so it can be used
+# to inspect and convert PKG files outside of Blender.
+
+import struct
+import numpy as np
+
+from io_scene_pkg.fvf import FVF
+from io_scene_pkg.shader_set import ShaderSet
+
+import io_scene_pkg.binary_helper as bin
+
+######################################################
+# STRUCTS
+######################################################
+GEOMETRY_HEADER_STRUCT = struct.Struct('<5L')
+SECTION_HEADER_STRUCT = struct.Struct('<HH')
+
+######################################################
+# GEOMETRY
+######################################################
+class GeometryData:
+    """Decoded geometry FILE. Vertex data is in PKG space, triangles index into the
+       vertex arrays, and material_indices holds the section of every triangle"""
+    def __init__(self):
+        self.fvf = FVF()
+        self.shader_offsets = []
+        self.positions = np.empty((0, 3), dtype=np.float32)
+        self.normals = np.empty((0, 3), dtype=np.float32)
+        self.uvs = np.empty((0, 2), dtype=np.float32)
+        self.diffuse = None
+        self.specular = None
+        self.triangles = np.empty((0, 3), dtype=np.int32)
+        self.material_indices = np.empty(0, dtype=np.int32)
+
+    @property
+    def num_vertices(self):
+        return len(self.positions)
+
+    @property
+    def num_triangles(self):
+        return len(self.triangles)
+
+
+def read_vertex_block(file, FVF_FLAGS, compressed, count):
+    """read a block of PKG vertices into float arrays"""
+    block = bin.read_vertex_block(file, FVF_FLAGS, compressed, count)
+
+    vpos = block['position'].astype(np.float32)
+    vnorm = np.ones((count, 3), dtype=np.float32)
+    vuv = np.zeros((count, 2), dtype=np.float32)
+    vdiffuse = None
+    vspecular = None
+
+    if FVF_FLAGS.has_flag("D3DFVF_NORMAL"):
+        vnorm = (block['normal'].astype(np.float32) - 128) / 127 if compressed else block['normal'].astype(np.float32)
+    if FVF_FLAGS.has_flag("D3DFVF_DIFFUSE"):
+        vdiffuse = block['diffuse'].astype(np.float32) / 255
+    if FVF_FLAGS.has_flag("D3DFVF_SPECULAR"):
+        vspecular = block['specular'].astype(np.float32) / 255
+    if FVF_FLAGS.has_flag("D3DFVF_TEX1"):
+        vuv = ((block['uv'] / 128) - 128).astype(np.float32) if compressed else block['uv'].astype(np.float32)
+
+    return (vpos, vnorm, vuv, vdiffuse, vspecular)
+
+
+def convert_triangle_strips(tristrip_data):
+    """convert Midnight Club triangle strips into an array of triangles"""
+    tristrip_data = np.asarray(tristrip_data, dtype=np.uint16)
+
+    # flags processing
+    FLAG_CW = ((tristrip_data & (1 << 14)) != 0)
+    FLAG_END = ((tristrip_data & (1 << 15)) != 0)
+    INDEX = (tristrip_data & ~np.uint16((1 << 14) | (1 << 15))).astype(np.int32)
+
+    # anything after the last END flag is an unfinished strip, and gets dropped
+    strip_ends = np.flatnonzero(FLAG_END)
+    if len(strip_ends) == 0:
+        return np.empty((0, 3), dtype=np.int32)
+    strip_data_length = strip_ends[-1] + 1
+
+    # which strip every index belongs to, and where each strip starts
+    strip_ids = np.zeros(strip_data_length, dtype=np.int64)
+    strip_ids[1:] = np.cumsum(FLAG_END[:strip_data_length - 1])
+    strip_starts = np.concatenate(([0], strip_ends[:-1] + 1))
+
+    # every index followed by two more in the same strip starts a triangle
+    v = np.arange(max(strip_data_length - 2, 0))
+    v = v[strip_ids[v] == strip_ids[v + 2]]
+    if len(v) == 0:
+        return np.empty((0, 3), dtype=np.int32)
+    i0 = INDEX[v]
+    i1 = INDEX[v + 1]
+    i2 = INDEX[v + 2]
+    triangle_strip_ids = strip_ids[v]
+
+    # the winding starts from the cw flag on the first index of the strip, and flips
+    # after every triangle, unless that triangle is degenerate
+    flips = ~((i0 == i1) | (i0 == i2) | (i1 == i2))
+    flips_before = np.cumsum(flips) - flips
+    strip_first_triangle = np.concatenate(([True], triangle_strip_ids[1:] != triangle_strip_ids[:-1]))
+    strip_flips_before = flips_before[strip_first_triangle][np.cumsum(strip_first_triangle) - 1]
+    clockwise = FLAG_CW[strip_starts[triangle_strip_ids]] ^ (((flips_before - strip_flips_before) & 1) == 1)
+
+    triangles = np.empty((len(v), 3), dtype=np.int32)
+    triangles[:, 0] = np.where(clockwise, i1, i0)
+    triangles[:, 1] = np.where(clockwise, i0, i1)
+    triangles[:, 2] = i2
+    return triangles
+
+
+def read_geometry(file):
+    """read a geometry FILE"""
+    geometry = GeometryData()
+
+    num_sections, num_vertices_tot, num_indices_tot, num_sections_dupe, fvf = bin.unpack(file, GEOMETRY_HEADER_STRUCT)
+    FVF_FLAGS = FVF(fvf)
+    geometry.fvf = FVF_FLAGS
+
+    # data holders
+    positions = []
+    normals = []
+    uvs = []
+    diffuse = []
+    specular = []
+    triangles = []
+    material_indices = []
+
+    index_offset = 0
+
+    # read sections
+    for num in range(num_sections):
+        num_strips, strip_flags = bin.unpack(file, SECTION_HEADER_STRUCT)
+
+        # check section strip flag
+        FLAG_compact_strips = ((strip_flags & (1 << 8)) != 0)
+
+        shader_offset = bin.read_uint16(file) if FLAG_compact_strips else bin.read_uint32(file)
+        geometry.shader_offsets.append(shader_offset)
+
+        # read strips
+        for strip in range(num_strips):
+            prim_type = bin.read_uint16(file) if FLAG_compact_strips else bin.read_uint32(file)
+            num_vertices =  bin.read_uint16(file) if FLAG_compact_strips else bin.read_uint32(file)
+
+            # read vertices
+            vpos, vnorm, vuv, vdiffuse, vspecular = read_vertex_block(file, FVF_FLAGS, FLAG_compact_strips, num_vertices)
+            positions.append(vpos)
+            normals.append(vnorm)
+            uvs.append(vuv)
+            if vdiffuse is not None:
+                diffuse.append(vdiffuse)
+            if vspecular is not None:
+                specular.append(vspecular)
+
+            # read indices
+            num_indices = bin.read_uint16(file) if FLAG_compact_strips else bin.read_uint32(file)
+
+            index_data = np.frombuffer(file.read(2 * num_indices), dtype='<u2', count=num_indices)
+            if FLAG_compact_strips and prim_type == 4:
+                strip_triangles = convert_triangle_strips(index_data)
+            else:
+                strip_triangles = index_data[:num_indices - (num_indices % 3)].astype(np.int32).reshape(-1, 3)
+
+            # drop triangles pointing outside of this strip
+            strip_triangles = strip_triangles[(strip_triangles < num_vertices).all(axis=1)]
+
+            triangles.append(strip_triangles + index_offset)
+            material_indices.append(np.full(len(strip_triangles), num, dtype=np.int32))
+
+            index_offset += num_vertices
+
+    if len(positions) > 0:
+        geometry.positions = np.concatenate(positions)
+        geometry.normals = np.concatenate(normals)
+        geometry.uvs = np.concatenate(uvs)
+        geometry.triangles = np.concatenate(triangles)
+        geometry.material_indices = np.concatenate(material_indices)
+        if len(diffuse) > 0:
+            geometry.diffuse = np.concatenate(diffuse)
+        if len(specular) > 0:
+            geometry.specular = np.concatenate(specular)
+
+    return geometry
+
+
+def read_geometry_at(source, offset):
+    """read the geometry FILE at offset of a PKG. Used by import worker processes"""
+    with bin.BinaryReader(source) as file:
+        file.seek(offset)
+        return read_geometry(file)
+
+
+def skip_geometry(file):
+    """seek past a geometry FILE, reading only its headers"""
+    num_sections, num_vertices_tot, num_indices_tot, num_sections_dupe, fvf = bin.unpack(file, GEOMETRY_HEADER_STRUCT)
+    FVF_FLAGS = FVF(fvf)
+
+    for num in range(num_sections):
+        num_strips, strip_flags = bin.unpack(file, SECTION_HEADER_STRUCT)
+        FLAG_compact_strips = ((strip_flags & (1 << 8)) != 0)
+        read_count = bin.read_uint16 if FLAG_compact_strips else bin.read_uint32
+        vertex_size = bin.get_vertex_dtype(FVF_FLAGS, FLAG_compact_strips).itemsize
+
+        read_count(file) # shader offset
+        for strip in range(num_strips):
+            read_count(file) # prim type
+            file.seek(read_count(file) * vertex_size, 1)
+            file.seek(read_count(file) * 2, 1)
+
+######################################################
+# XREFS / OFFSET
+######################################################
+class XRef:
+    def __init__(self, name="", matrix=None):
+        self.name = name
+        self.matrix = matrix if matrix is not None else (1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0)
+
+
+def read_xrefs(file):
+    """read an xrefs FILE into a list of XRef"""
+    xrefs = []
+    num_xrefs = bin.read_uint32(file)
+    for num in range(num_xrefs):
+        mtx = bin.unpack(file, bin.STRUCT_MATRIX3X4)
+
+        # read in xref name, and remove junk Angel Studios didn't null
+        xref_name_bytes = bytearray(file.read(32))
+        for b in range(len(xref_name_bytes)):
+          if xref_name_bytes[b] > 126:
+            xref_name_bytes[b] = 0
+
+        xrefs.append(XRef(xref_name_bytes.decode("utf-8"), mtx))
+    return xrefs
+
+
+def read_offset(file):
+    return bin.read_float3(file)
+
+######################################################
+# PKG
+######################################################
+class PKGFileEntry:
+    """A FILE in a PKG. The payload is decoded the first time data is accessed"""
+    def __init__(self, pkg, name, offset, length):
+        self.pkg = pkg
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self._data = None
+
+    @property
+    def type(self):
+        if self.name == "shaders":
+            return "shaders"
+        elif self.name == "offset":
+            return "offset"
+        elif self.name == "xrefs":
+            return "xrefs"
+        return "geometry"
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.pkg.read_entry(self)
+        return self._data
+
+
+class PKGFile:
+    """A PKG2/PKG3 file. Opening one only builds the table of contents"""
+    def __init__(self, source=None):
+        self.version = 3
+        self.entries = []
+        self.reader = None
+
+        if source is not None:
+            self.open(source)
+
+    def open(self, source):
+        """open a PKG from a file path, or bytes"""
+        self.reader = bin.BinaryReader(source)
+        self.entries = []
+
+        pkg_version = str(self.reader.read(4), "utf-8", errors="replace")
+        if pkg_version != "PKG3" and pkg_version != "PKG2":
+            self.close()
+            raise Exception("PKG file is wrong format : " + pkg_version)
+        self.version = int(pkg_version[-1:])
+
+        try:
+            self.__read_table_of_contents()
+        except (struct.error, ValueError, EOFError) as e:
+            self.close()
+            raise Exception("PKG file is truncated or corrupt : " + str(e))
+
+    def __read_table_of_contents(self):
+        file = self.reader
+        while file.tell() < file.size:
+            file_header = str(file.read(4), "utf-8", errors="replace")
+            if file_header != "FILE":
+                raise ValueError("missing FILE header at " + str(file.tell()))
+
+            file_name = bin.read_angel_string(file)
+            if self.version == 2:
+                # PKG2 has no lengths, walk the payload to find the next FILE
+                entry = PKGFileEntry(self, file_name, file.tell(), 0)
+                self.__skip_entry(entry)
+                entry.length = file.tell() - entry.offset
+            else:
+                file_length = bin.read_uint32(file)
+
+                # Angel released a very small batch of corrupt PKG files
+                # this is here just in case someone tries to import one
+                if file_length == 0:
+                    raise ValueError("Invalid PKG3 file : cannot have file length of 0")
+
+                entry = PKGFileEntry(self, file_name, file.tell(), file_length)
+                file.seek(file_length, 1)
+                
+            if file.tell() > file.size:
+                raise ValueError("FILE " + file_name + " ends past the end of the PKG")
+
+            self.entries.append(entry)
+
+    def __skip_entry(self, entry):
+        file = self.reader
+        if entry.type == "shaders":
+            entry._data = ShaderSet(file)
+        elif entry.type == "offset":
+            file.seek(12, 1)
+        elif entry.type == "xrefs":
+            entry._data = read_xrefs(file)
+        else:
+            skip_geometry(file)
+
+    def read_entry(self, entry):
+        """decode the payload of an entry"""
+        file = self.reader
+        file.seek(entry.offset)
+
+        if entry.type == "shaders":
+            return ShaderSet(file)
+        elif entry.type == "offset":
+            return read_offset(file)
+        elif entry.type == "xrefs":
+            return read_xrefs(file)
+        return read_geometry(file)
+
+    def get(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,292 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Created by Dummiesman, 2016-2020
+#
+# ##### END LICENSE BLOCK #####
+
+import bpy
+import os, time
+
+from bpy.props import (
+        BoolProperty,
+        EnumProperty,
+        FloatProperty,
+        StringProperty,
+        CollectionProperty,
+        IntProperty,
+        PointerProperty
+        )
+from bpy_extras.io_utils import (
+        ImportHelper,
+        ExportHelper,
+        )
+        
+import io_scene_pkg.import_helper as import_helper
+
+class PKGImportSettings:
+    """import settings shared by the single file and batch operators"""
+    weld_tolerance: FloatProperty(
+        name="Weld Tolerance",
+        description="Snap vertex positions to a grid of this size, and merge vertices in the same grid cell with similar normals. 0 only merges identical vertices",
+        default=0.0,
+        min=0.0,
+        precision=5,
+        )
+        
+    import_lods: EnumProperty(
+        name="LODs",
+        description="Levels of detail to import. Objects without a LOD suffix are always imported",
+        items=(('H', "High", "Import _H objects"),
+               ('M', "Medium", "Import _M objects"),
+               ('L', "Low", "Import _L objects"),
+               ('VL', "Very Low", "Import _VL objects")),
+        options={'ENUM_FLAG'},
+        default={'H', 'M', 'L', 'VL'},
+        )
+        
+    include_patterns: StringProperty(
+        name="Include",
+        description="Comma separated name patterns (e.g. BODY_*,WHL*). Only matching objects are imported. Leave empty to import everything",
+        default="",
+        )
+        
+    exclude_patterns: StringProperty(
+        name="Exclude",
+        description="Comma separated name patterns (e.g. BREAK*,*GLOW*). Matching objects are skipped",
+        default="",
+        )
+        
+    use_multiprocessing: BoolProperty(
+        name="Parallel Decoding",
+        description="Decode geometry in worker processes. Speeds up large PKG files, small ones are faster without",
+        default=False,
+        )
+        
+    worker_count: IntProperty(
+        name="Workers",
+        description="Number of worker processes for parallel decoding. 0 uses one per CPU core",
+        default=0,
+        min=0,
+        )
+
+
+class ImportPKG(bpy.types.Operator, ImportHelper, PKGImportSettings):
+    """Import from PKG file format (.pkg)"""
+    bl_idname = "import_scene.pkg"
+    bl_label = 'Import PKG'
+    bl_options = {'UNDO'}
+
+    filename_ext = ".pkg"
+    filter_glob: StringProperty(default="*.pkg", options={'HIDDEN'})
+
+    import_variants: BoolProperty(
+        name="Import Variants",
+        description="Import variants from this file. Will clear existing variant data in the scene.",
+        default=True,
+        )
+        
+    # set when invoked from the UI, scripts get a blocking import
+    run_modal: BoolProperty(default=False, options={'HIDDEN', 'SKIP_SAVE'})
+    
+    # seconds of import work per timer event
+    modal_step_time = 0.05
+    
+    def invoke(self, context, event):
+        self.run_modal = True
+        return ImportHelper.invoke(self, context, event)
+        
+    def execute(self, context):
+        from . import import_pkg
+        keywords = self.as_keywords(ignore=("axis_forward",
+                                            "axis_up",
+                                            "filter_glob",
+                                            "check_existing",
+                                            "run_modal",
+                                            ))
+
+        if not self.run_modal or context.window is None:
+            return import_pkg.load(self, context, **keywords)
+        
+        # import FILE's from timer events, so Blender stays responsive
+        del keywords["filepath"]
+        self._snapshot = import_helper.get_datablock_snapshot()
+        self._steps = import_pkg.load_pkg_iter(self.filepath, context, **keywords)
+        self._progress = (0, 1)
+        
+        wm = context.window_manager
+        wm.progress_begin(0, 1)
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        self.update_status(context)
+        return {'RUNNING_MODAL'}
+        
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'}, "PKG import cancelled")
+            return {'CANCELLED'}
+        
+        if event.type != 'TIMER':
+            # allow viewport navigation, but not edits to the scene being imported into
+            if event.type in {'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE', 'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE'}:
+                return {'PASS_THROUGH'}
+            return {'RUNNING_MODAL'}
+        
+        step_start = time.perf_counter()
+        try:
+            while time.perf_counter() - step_start < self.modal_step_time:
+                self._progress = next(self._steps)
+        except StopIteration:
+            self.finish(context)
+            return {'FINISHED'}
+        except Exception:
+            self.cancel(context)
+            raise
+            
+        self.update_status(context)
+        return {'RUNNING_MODAL'}
+        
+    def update_status(self, context):
+        done, total = self._progress
+        context.window_manager.progress_update(done / max(total, 1))
+        context.workspace.status_text_set("Importing %s: FILE %d of %d. Press Esc to cancel" % (os.path.basename(self.filepath), done, total))
+        
+    def finish(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        
+    def cancel(self, context):
+        # closing the import generator stops its worker processes and closes the PKG
+        self._steps.close()
+        self.finish(context)
+        
+        # remove what was imported so far
+        import_helper.remove_new_datablocks(self._snapshot)
+        
+        # variants of this import lost their base materials. the old variants were 
+        # already cleared when this import read its shaders
+        angel = context.scene.angel
+        if any(vm.get_base_material() is None for variant in angel.variants for vm in variant.materials):
+            angel.clear()
+
+
+class ImportPKGBatch(bpy.types.Operator, ImportHelper, PKGImportSettings):
+    """Import a folder or a selection of PKG files (.pkg), each into its own collection"""
+    bl_idname = "import_scene.pkg_batch"
+    bl_label = 'Import PKG Batch'
+    bl_options = {'UNDO'}
+
+    filename_ext = ".pkg"
+    filter_glob: StringProperty(default="*.pkg", options={'HIDDEN'})
+    
+    directory: StringProperty(subtype='DIR_PATH', options={'HIDDEN', 'SKIP_SAVE'})
+    files: CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    
+    def get_filepaths(self):
+        """selected files, or every PKG in the directory if nothing is selected"""
+        filenames = [file.name for file in self.files if file.name.lower().endswith(".pkg")]
+        if len(filenames) == 0 and os.path.isdir(self.directory):
+            filenames = sorted(filename for filename in os.listdir(self.directory) if filename.lower().endswith(".pkg"))
+        return [os.path.join(self.directory, filename) for filename in filenames]
+        
+    def execute(self, context):
+        from . import import_pkg
+        keywords = self.as_keywords(ignore=("axis_forward",
+                                            "axis_up",
+                                            "filter_glob",
+                                            "check_existing",
+                                            "filepath",
+                                            "directory",
+                                            "files",
+                                            ))
+        
+        filepaths = self.get_filepaths()
+        if len(filepaths) == 0:
+            self.report({'ERROR'}, "No PKG files found in " + self.directory)
+            return {'CANCELLED'}
+            
+        return import_pkg.load_batch(self, context, filepaths, **keywords)
+
+
+class ExportPKG(bpy.types.Operator, ExportHelper):
+    """Export to PKG file format (.PKG)"""
+    bl_idname = "export_scene.pkg"
+    bl_label = 'Export PKG'
+
+    filename_ext = ".pkg"
+    filter_glob: StringProperty(
+            default="*.pkg",
+            options={'HIDDEN'},
+            )
+
+    e_vertexcolors: BoolProperty(
+        name="Vertex Colors (Diffuse)",
+        description="Export vertex colors that affect diffuse",
+        default=False,
+        )
+        
+    e_vertexcolors_s: BoolProperty(
+        name="Vertex Colors (Specular)",
+        description="Export vertex colors that affect specular",
+        default=False,
+        )
+        
+    apply_modifiers: BoolProperty(
+        name="Apply Modifiers",
+        description="Do you desire modifiers to be applied in the PKG?",
+        default=True,
+        )
+        
+    selection_only: BoolProperty(
+        name="Selection Only",
+        description="Export only selected elements",
+        default=False,
+        )
+        
+    def execute(self, context):
+        from . import export_pkg
+        
+        keywords = self.as_keywords(ignore=("axis_forward",
+                                            "axis_up",
+                                            "filter_glob",
+                                            "check_existing",
+                                            ))
+                                    
+        return export_pkg.save(self, context, **keywords)
+
+
+# Add to a menu
+def menu_func_export(self, context):
+    self.layout.operator(ExportPKG.bl_idname, text="Angel Studios ModPackage (.pkg)")
+
+
+def menu_func_import(self, context):
+    self.layout.operator(ImportPKG.bl_idname, text="Angel Studios ModPackage (.pkg)")
+    self.layout.operator(ImportPKGBatch.bl_idname, text="Angel Studios ModPackage Batch (.pkg)")
+
+# Register factories
+classes = (
+    ImportPKG,
+    ImportPKGBatch,
+    ExportPKG
+)
+
+def register():
+    for cls in classes:
+        bpy.utils.register_class(cls)
+    
+    bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
+
+
+def unregister():
+    bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
+    
+    for cls in reversed(classes):
+        bpy.utils.unregister_class(cls)
@@ -34,7 +34,7 @@ class Shader:
             bin.write_color4f(file, self.specular_color)
             bin.write_color4f(file, self.emissive_color)
             
-        file.write(struct.pack('f', self.shininess))
+        file.write(struct.pack('<f', self.shininess))
         
     def read(self, file, type):
         type = type if type is not None else self.type
@@ -71,26 +71,20 @@ class Shader:
         if file is not None and type is not None:
             self.read(file, type)
 
-    @staticmethod
-    def __iter_check_equal(i1, i2):
-        l1 = len(i1)
-        l2 = len(i2)
-        if l1 != l2:
-            return False
-        for idx in range(l1):
-            if i1[idx] != i2[idx]:
-                return False
-        return True
+    def key(self):
+        """hashable key of everything that makes up this shader. shaders are mutable 
+           and not hashable themselves, use the key to look them up in dicts and sets"""
+        return (self.name, 
+                tuple(self.diffuse_color), 
+                tuple(self.ambient_color), 
+                tuple(self.specular_color), 
+                tuple(self.emissive_color), 
+                self.shininess)
         
     def __eq__(self, obj):
         if not isinstance(obj,Shader):
             return False
-         
-        return (Shader.__iter_check_equal(obj.diffuse_color, self.diffuse_color) and
-               Shader.__iter_check_equal(obj.ambient_color, self.ambient_color) and
-               Shader.__iter_check_equal(obj.specular_color, self.specular_color) and
-               Shader.__iter_check_equal(obj.emissive_color, self.emissive_color) and
-               obj.shininess == self.shininess and obj.name == self.name)
+        return self.key() == obj.key()
         
     def __ne__(self, obj):
         return not self == obj
@@ -98,7 +92,7 @@ class Shader:
 
 class ShaderSet:
     def read(self, file):
-        shadertype_raw, shaders_per_variant = struct.unpack('2L', file.read(8))
+        shadertype_raw, shaders_per_variant = bin.read_uint32(file), bin.read_uint32(file)
         
         self.type = "float"
         self.num_variants = shadertype_raw
@@ -9,7 +9,7 @@
 
 from enum import IntEnum
 import struct
-import bpy
+import numpy as np
 
 class TEXType(IntEnum):
     P8 = 1
@@ -21,23 +21,139 @@ class TEXType(IntEnum):
     RGB888 = 17
     RGB8888 = 18
     
-class TEXFile:
-    def to_blender_image(self, name= 'tex_image', pack = True):
-        im = bpy.data.images.new(name=name, width=self.width, height=self.height, alpha=self.is_alpha_format())
-        pixels = list(im.pixels)
+# byte to float conversion, matching value / 255
+BYTE_TO_FLOAT = (np.arange(256, dtype=np.float64) / 255).astype(np.float32)
+
+class MedianCutPalette:
+    """median cut color quantization. the palette boxes are a tree of channel splits,
+       so any color maps to its palette entry without a nearest color search"""
+    @staticmethod
+    def pack_colors(colors, bits = 8):
+        """pack (N, channels) colors of the given bits per channel into one integer each"""
+        packed = np.zeros(len(colors), dtype=np.uint32)
+        for channel in range(colors.shape[1]):
+            packed |= colors[:, channel].astype(np.uint32) << (bits * channel)
+        return packed
+        
+    @staticmethod
+    def unpack_colors(packed, channels, bits = 8):
+        mask = (1 << bits) - 1
+        return np.stack([(packed >> (bits * channel)) & mask for channel in range(channels)], axis=1).astype(np.uint8)
         
-        for y in range(self.height):
-            for x in range(self.width):
-                flipped_y = self.height - y - 1
-                b_pixel_index = 4 * ((flipped_y * self.width) + x)
-                pixel_color = self.get_pixel(x, y)
+    def __init__(self, colors, palette_size):
+        # boxes are made of unique colors weighted by their pixel count. images with few 
+        # colors keep them exactly, others are boxed on a 5 bit per channel histogram (4 with alpha)
+        channels = colors.shape[1]
+        packed, counts = np.unique(MedianCutPalette.pack_colors(colors), return_counts=True)
+        self.bits = 8 if len(packed) <= palette_size else (5 if channels <= 3 else 4)
+        if self.bits != 8:
+            counts = np.bincount(MedianCutPalette.pack_colors(colors >> (8 - self.bits), self.bits))
+            packed = np.nonzero(counts)[0].astype(np.uint32)
+            counts = counts[packed]
+        self.colors = MedianCutPalette.unpack_colors(packed, channels, self.bits)
+        self.counts = counts
+        
+        # tree nodes. internal nodes send colors <= split_value in split_channel to the left child
+        self.split_channel = []
+        self.split_value = []
+        self.left = []
+        self.right = []
+        self.palette_index = []
+        
+        # split the box with the most weight * range until the palette is full
+        leaves = [self.__make_leaf(np.arange(len(self.colors)))]
+        while len(leaves) < palette_size:
+            best = max(range(len(leaves)), key=lambda leaf: leaves[leaf][2])
+            node, indices, score, channel, threshold = leaves[best]
+            if score <= 0:
+                break # every box is a single color
                 
-                pixels[b_pixel_index] = pixel_color[0]
-                pixels[b_pixel_index+1] = pixel_color[1]
-                pixels[b_pixel_index+2] = pixel_color[2]
-                pixels[b_pixel_index+3] = pixel_color[3]
-    
-        im.pixels = pixels[:]
+            go_left = self.colors[indices, channel] <= threshold
+            left_leaf = self.__make_leaf(indices[go_left])
+            right_leaf = self.__make_leaf(indices[~go_left])
+            
+            self.split_channel[node] = channel
+            self.split_value[node] = threshold
+            self.left[node] = left_leaf[0]
+            self.right[node] = right_leaf[0]
+            leaves[best] = left_leaf
+            leaves.append(right_leaf)
+        
+        for palette_index, leaf in enumerate(leaves):
+            self.palette_index[leaf[0]] = palette_index
+            
+        self.split_channel = np.array(self.split_channel)
+        self.split_value = np.array(self.split_value)
+        self.left = np.array(self.left)
+        self.right = np.array(self.right)
+        self.palette_index = np.array(self.palette_index)
+        
+        # palette colors are the mean of the pixels in each box
+        indices = self.get_indices(colors)
+        pixel_counts = np.bincount(indices, minlength=len(leaves))
+        self.palette = np.empty((len(leaves), channels), dtype=np.uint8)
+        for channel in range(channels):
+            self.palette[:, channel] = np.rint(np.bincount(indices, weights=colors[:, channel], minlength=len(leaves)) / pixel_counts)
+            
+    def __make_leaf(self, indices):
+        """add a leaf node for a box of unique colors. returns [node, indices, score, split channel, split value]"""
+        node = len(self.palette_index)
+        self.split_channel.append(0)
+        self.split_value.append(0)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.palette_index.append(-1)
+        
+        box_colors = self.colors[indices]
+        box_min = box_colors.min(axis=0).astype(np.int64)
+        box_max = box_colors.max(axis=0).astype(np.int64)
+        channel = int(np.argmax(box_max - box_min))
+        color_range = box_max[channel] - box_min[channel]
+        if color_range == 0:
+            return [node, indices, 0, 0, 0]
+            
+        # split at the weighted median, keeping both sides non empty
+        values = box_colors[:, channel]
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(self.counts[indices][order])
+        median = int(values[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+        threshold = median if median < box_max[channel] else median - 1
+        return [node, indices, int(color_range * cumulative[-1]), channel, threshold]
+        
+    def get_indices(self, colors):
+        """map (N, channels) uint8 colors to palette indices"""
+        # walk the tree once per unique color
+        if self.bits == 8:
+            packed, inverse = np.unique(MedianCutPalette.pack_colors(colors), return_inverse=True)
+            return self.get_unique_indices(MedianCutPalette.unpack_colors(packed, colors.shape[1]))[inverse.ravel()]
+        
+        packed = MedianCutPalette.pack_colors(colors >> (8 - self.bits), self.bits)
+        used_bins = np.nonzero(np.bincount(packed))[0]
+        bin_indices = np.zeros(used_bins[-1] + 1, dtype=np.int64)
+        bin_indices[used_bins] = self.get_unique_indices(MedianCutPalette.unpack_colors(used_bins.astype(np.uint32), colors.shape[1], self.bits))
+        return bin_indices[packed]
+        
+    def get_unique_indices(self, colors):
+        node = np.zeros(len(colors), dtype=np.int64)
+        active = np.nonzero(self.left[node] >= 0)[0]
+        while len(active) > 0:
+            active_node = node[active]
+            go_left = colors[active, self.split_channel[active_node]] <= self.split_value[active_node]
+            node[active] = np.where(go_left, self.left[active_node], self.right[active_node])
+            active = active[self.left[node[active]] >= 0]
+        return self.palette_index[node]
+
+
+class TEXFile:
+    def get_pixels(self):
+        """decode the first mip into a flat RGBA float32 array, bottom row first like Blender images.
+           this doesn't touch Blender data, so it can run on a worker thread"""
+        return self.decode_mip(0)[::-1].ravel()
+        
+    def to_blender_image(self, name= 'tex_image', pack = True, pixels = None):
+        import bpy
+        im = bpy.data.images.new(name=name, width=self.width, height=self.height, alpha=self.is_alpha_format())
+        im.pixels.foreach_set(pixels if pixels is not None else self.get_pixels())
         im.update()
         
         if pack:
@@ -46,21 +162,19 @@ class TEXFile:
         return im
         
     def __read_palette(self, file, color_count):
-        for x in range(color_count):
-            col_data = file.read(4)
-
-            # add to palette, reordering BGRA to RGBA
-            self.palette.append((col_data[2] / 255, col_data[1] / 255, col_data[0] / 255, col_data[3] / 255)) 
+        # reorder BGRA to RGBA
+        col_data = np.frombuffer(file.read(color_count * 4), dtype=np.uint8).reshape((color_count, 4))
+        self.palette = BYTE_TO_FLOAT[col_data[:, (2, 1, 0, 3)]]
     
     def __make_palette_opaque(self):
-        for i in range(len(self.palette)):
-            pal_color = list(self.palette[i])
-            pal_color[3] = 1.0
-            self.palette[i] = tuple(pal_color)
+        self.palette[:, 3] = 1.0
     
     def is_paletted_format(self):
         return self.format != TEXType.RGB888 and self.format != TEXType.RGB8888 and self.format != TEXType.A1R5G5B5
         
+    def is_4bit_format(self):
+        return self.format == TEXType.P4 or self.format == TEXType.PA4
+        
     def is_alpha_format(self):
         return self.format != TEXType.P8 and self.format != TEXType.P4 and self.format != TEXType.RGB888
     
@@ -117,118 +231,200 @@ class TEXFile:
         retval = (size[0] * size[1]) // -stride if stride < 0 else (size[0] * size[1]) * stride
         return retval;
     
-    def __get_pixel_pa4_p4(self, x, y, stride, mip_data, mip_size, data_index):
-        nibbles = mip_data[data_index]
-        nibble1 = nibbles & 0x0F
-        nibble2 = (nibbles & 0xF0) >> 4
-        nibbleIdx = (x / -stride) + (y * (mip_size[0]  / -stride))
-        return self.palette[nibble2] if nibbleIdx > 0 else self.palette[nibble1]
-        
-    def __get_pixel_pa8_p8(self, x, y, stride, mip_data, mip_size, data_index):
-        pal_index = mip_data[data_index]
-        return self.palette[pal_index]
-        
-    def __get_pixel_p8a8(self, x, y, stride, mip_data, mip_size, data_index):
-        pal_index = mip_data[data_index]
-        alpha = mip_data[data_index + 1]
-        color = self.palette[pal_index]
-        return (color[0], color[1], color[2], alpha / 255)
-       
-    def __get_pixel_rgb888(self, x, y, stride, mip_data, mip_size, data_index):
-        return (mip_data[data_index] / 255, mip_data[data_index + 1] / 255, mip_data[data_index + 2] / 255, 1.0)
-        
-    def __get_pixel_rgb8888(self, x, y, stride, mip_data, mip_size, data_index):
-        return (mip_data[data_index] / 255, mip_data[data_index + 1] / 255, mip_data[data_index + 2] / 255, mip_data[data_index + 3] / 255)
-        
-    def __get_pixel_a1r5g5b5(self, x, y, stride, mip_data, mip_size, data_index):
-        color_short = struct.unpack('<H', (mip_data[data_index], mip_data[data_index + 1]))[0]
-        maskA = 32768 
-        maskR = 0x7C00
-        maskG = 0x3E0
-        maskB = 0x1F
-
-        alpha = ((maskA & color_short) >> 8)
-        red = ((maskR & color_short) >> 7)
-        green = ((maskG & color_short) >> 2)
-        blue = ((maskB & color_short) << 3)
-        alpha = 255 if alpha > 0 else 0
-
-        red = red | 0xF if (red & 0x8) == 0x8 else red
-        green = green | 0xF if (red & 0x8) == 0x8 else green
-        blue = blue | 0xF if (red & 0x8) == 0x8 else blue
-
-        return (red / 255, green / 255, blue / 255, alpha / 255)
+    def __decode_p8(self, mip_data, width, height):
+        return self.palette[mip_data[:width * height]]
         
-    def get_pixel(self, x, y, mip_level = 0):
-        mip_data = self.mipmaps[mip_level]
-        mip_size = self.calculate_mip_size(mip_level)
-        stride = self.get_stride()
+    def __decode_p8a8(self, mip_data, width, height):
+        data = mip_data[:width * height * 2].reshape((-1, 2))
+        pixels = self.palette[data[:, 0]]
+        pixels[:, 3] = BYTE_TO_FLOAT[data[:, 1]]
+        return pixels
         
-        data_index =  (x * stride) + (y * (mip_size[0] * stride)) if stride > 0 else (x // -stride) + (y * (mip_size[0] // -stride))
-
-        get_pixel_functions = (None, 
-                               self.__get_pixel_pa8_p8, 
-                               self.__get_pixel_p8a8, 
-                               None, 
-                               None, 
-                               None, 
-                               self.__get_pixel_a1r5g5b5, 
-                               None, 
-                               None, 
-                               None, 
-                               None, 
-                               None, 
-                               None, 
-                               None,
-                               self.__get_pixel_pa8_p8, 
-                               self.__get_pixel_pa4_p4, 
-                               self.__get_pixel_pa4_p4,
-                               self.__get_pixel_rgb888,
-                               self.__get_pixel_rgb8888
-                              )
-
-            
-        fmt_int = int(self.format)
-        if fmt_int >= 0 and fmt_int <= 18:
-            return get_pixel_functions[fmt_int](x, y, stride, mip_data, mip_size, data_index)
-        else:
-            return (0, 0, 0, 0)
+    def __decode_p4(self, mip_data, width, height):
+        # two pixels per byte, low nibble first
+        nibbles = np.empty((len(mip_data), 2), dtype=np.uint8)
+        nibbles[:, 0] = mip_data & 0x0F
+        nibbles[:, 1] = mip_data >> 4
+        return self.palette[nibbles.ravel()[:width * height]]
+        
+    def __decode_rgb888(self, mip_data, width, height):
+        pixels = np.ones((width * height, 4), dtype=np.float32)
+        pixels[:, :3] = BYTE_TO_FLOAT[mip_data[:width * height * 3].reshape((-1, 3))]
+        return pixels
+        
+    def __decode_rgb8888(self, mip_data, width, height):
+        return BYTE_TO_FLOAT[mip_data[:width * height * 4].reshape((-1, 4))]
+        
+    def __decode_a1r5g5b5(self, mip_data, width, height):
+        color_short = mip_data[:width * height * 2].view('<u2').astype(np.uint16)
+        
+        red = (color_short >> 10) & 0x1F
+        green = (color_short >> 5) & 0x1F
+        blue = color_short & 0x1F
+        alpha = np.where(color_short & 0x8000, 255, 0)
+        
+        # expand 5 bit channels to 8 bit, so 0x1F becomes 0xFF
+        pixels = np.empty((width * height, 4), dtype=np.float32)
+        pixels[:, 0] = BYTE_TO_FLOAT[(red << 3) | (red >> 2)]
+        pixels[:, 1] = BYTE_TO_FLOAT[(green << 3) | (green >> 2)]
+        pixels[:, 2] = BYTE_TO_FLOAT[(blue << 3) | (blue >> 2)]
+        pixels[:, 3] = BYTE_TO_FLOAT[alpha]
+        return pixels
+        
+    def decode_mip(self, mip_level = 0):
+        """decode a mip into a (height, width, 4) RGBA float32 array, top row first"""
+        width, height = self.calculate_mip_size(mip_level)
+        mip_data = np.frombuffer(self.mipmaps[mip_level], dtype=np.uint8)
+        
+        decode_functions = {TEXType.P8: self.__decode_p8,
+                            TEXType.PA8: self.__decode_p8,
+                            TEXType.P8A8: self.__decode_p8a8,
+                            TEXType.P4: self.__decode_p4,
+                            TEXType.PA4: self.__decode_p4,
+                            TEXType.RGB888: self.__decode_rgb888,
+                            TEXType.RGB8888: self.__decode_rgb8888,
+                            TEXType.A1R5G5B5: self.__decode_a1r5g5b5}
+                            
+        pixels = decode_functions[self.format](mip_data, width, height)
+        return pixels.reshape((height, width, 4))
 
 
-    def read(self, filepath):
-        file = open(filepath, 'rb')
+    def __encode_paletted(self, palette, rgba):
+        indices = palette.get_indices(rgba[:, :palette.palette.shape[1]]).astype(np.uint8)
+        if self.format == TEXType.P8A8:
+            return np.stack((indices, rgba[:, 3]), axis=1)
+        elif self.format == TEXType.P4 or self.format == TEXType.PA4:
+            # two pixels per byte, low nibble first
+            return indices[0::2] | (indices[1::2] << 4)
+        return indices
+        
+    def __encode_a1r5g5b5(self, rgba):
+        rgba = rgba.astype(np.uint16)
+        color_short = (np.where(rgba[:, 3] >= 128, 0x8000, 0).astype(np.uint16) |
+                       ((rgba[:, 0] >> 3) << 10) |
+                       ((rgba[:, 1] >> 3) << 5) |
+                       (rgba[:, 2] >> 3))
+        return color_short.astype('<u2')
         
-        width, height, format = struct.unpack('<HHH', file.read(6))
-        self.width = width
-        self.height = height
+    def encode(self, pixels, format, generate_mips = True):
+        """encode (height, width, 4) RGBA float pixels, top row first, into this texture"""
         self.format = TEXType(format)
+        self.height, self.width = pixels.shape[:2]
         
-        mipcount, garbage, flags = struct.unpack('<HHL', file.read(8))
+        # 4 bit formats store two pixels per byte, a level with an odd pixel count can't be read back
+        if self.is_4bit_format() and (self.width * self.height) % 2 != 0:
+            raise Exception("P4 and PA4 textures need an even number of pixels, got " + str(self.width) + "x" + str(self.height))
+        
+        # box filtered mip chain, down to the smallest level the format can store
+        levels = [np.asarray(pixels, dtype=np.float32)]
+        while generate_mips:
+            width, height = self.calculate_mip_size(len(levels))
+            if width == 0 or height == 0 or self.calculate_mip_array_size(len(levels)) == 0:
+                break
+            if self.is_4bit_format() and (width * height) % 2 != 0:
+                break
+            level = levels[-1][:height * 2, :width * 2]
+            levels.append(level.reshape((height, 2, width, 2, 4)).mean(axis=(1, 3)))
+        levels = [np.rint(np.clip(level, 0.0, 1.0) * 255).astype(np.uint8).reshape((-1, 4)) for level in levels]
         
-        # read palette if paletted format
-        if self.format == TEXType.P4 or self.format == TEXType.PA4:
-            self.__read_palette(file, 16)
-        elif self.format == TEXType.P8A8 or self.format == TEXType.PA8 or self.format == TEXType.P8:
-            self.__read_palette(file, 256)
+        # one palette for every mip. P8A8 stores alpha per pixel, P8 and P4 have none
+        palette = None
+        if self.is_paletted_format():
+            palette_channels = 4 if self.format == TEXType.PA8 or self.format == TEXType.PA4 else 3
+            palette_size = 16 if self.format == TEXType.P4 or self.format == TEXType.PA4 else 256
+            palette = MedianCutPalette(levels[0][:, :palette_channels], palette_size)
             
-        # make opaque palette if format doesn't support alpha
-        if self.format == TEXType.P8 or self.format == TEXType.P4:
-            self.__make_palette_opaque()
-         
-        # read mips
-        for i in range(mipcount):
-            mip_data_size = self.calculate_mip_array_size(i)
-            if mip_data_size == 0:
+            palette_rgba = np.full((palette_size, 4), 255, dtype=np.uint8)
+            palette_rgba[:len(palette.palette), :palette_channels] = palette.palette
+            palette_rgba[len(palette.palette):] = 0
+            self.palette = BYTE_TO_FLOAT[palette_rgba]
+            
+        self.mipmaps = []
+        for rgba in levels:
+            if palette is not None:
+                mip_data = self.__encode_paletted(palette, rgba)
+            elif self.format == TEXType.A1R5G5B5:
+                mip_data = self.__encode_a1r5g5b5(rgba)
+            elif self.format == TEXType.RGB888:
+                mip_data = rgba[:, :3]
+            else:
+                mip_data = rgba
+            self.mipmaps.append(np.ascontiguousarray(mip_data).tobytes())
+            
+    def from_blender_image(self, image, format, generate_mips = True):
+        pixels = np.empty(image.size[0] * image.size[1] * 4, dtype=np.float32)
+        image.pixels.foreach_get(pixels)
+        self.encode(pixels.reshape((image.size[1], image.size[0], 4))[::-1], format, generate_mips)
+        
+    def write(self, filepath):
+        with open(filepath, 'wb') as file:
+            file.write(struct.pack('<HHH', self.width, self.height, int(self.format)))
+            file.write(struct.pack('<HHL', len(self.mipmaps), 0, 0))
+            
+            # palette is stored as BGRA
+            if self.is_paletted_format():
+                palette_rgba = np.rint(self.palette * 255).astype(np.uint8)
+                file.write(np.ascontiguousarray(palette_rgba[:, (2, 1, 0, 3)]).tobytes())
+                
+            for mip_data in self.mipmaps:
+                file.write(mip_data)
+                
+    def get_mip_for_size(self, max_size, mip_count):
+        """the first mip no larger than max_size in either dimension, or the smallest one"""
+        mip = 0
+        while max_size > 0 and mip + 1 < mip_count:
+            width, height = self.calculate_mip_size(mip)
+            if max(width, height) <= max_size or self.calculate_mip_array_size(mip + 1) == 0:
                 break
-            data = file.read(mip_data_size)
-            self.mipmaps.append(data)
+            mip += 1
+        return mip
+        
+    def read(self, filepath, max_size = 0):
+        """read a TEX file. with a max_size, only the first mip that fits is read,
+           and it becomes the texture's top level"""
+        with open(filepath, 'rb') as file:
+            width, height, format = struct.unpack('<HHH', file.read(6))
+            self.width = width
+            self.height = height
+            self.format = TEXType(format)
+            
+            mipcount, garbage, flags = struct.unpack('<HHL', file.read(8))
+            
+            # read palette if paletted format
+            if self.format == TEXType.P4 or self.format == TEXType.PA4:
+                self.__read_palette(file, 16)
+            elif self.format == TEXType.P8A8 or self.format == TEXType.PA8 or self.format == TEXType.P8:
+                self.__read_palette(file, 256)
+                
+            # make opaque palette if format doesn't support alpha
+            if self.format == TEXType.P8 or self.format == TEXType.P4:
+                self.__make_palette_opaque()
+            
+            # skip over larger mips without reading them
+            first_mip = self.get_mip_for_size(max_size, mipcount)
+            if first_mip > 0:
+                file.seek(sum(self.calculate_mip_array_size(i) for i in range(first_mip)), 1)
+                self.width, self.height = self.calculate_mip_size(first_mip)
+                mipcount -= first_mip
+            self.first_mip = first_mip
+                
+            # read mips, a reduced texture only needs the level it was reduced to
+            if max_size > 0:
+                mipcount = min(mipcount, 1)
+            for i in range(mipcount):
+                mip_data_size = self.calculate_mip_array_size(i)
+                if mip_data_size == 0:
+                    break
+                data = file.read(mip_data_size)
+                self.mipmaps.append(data)
     
-    def __init__(self, filepath=None):
-        self.palette = []
+    def __init__(self, filepath=None, max_size=0):
+        self.palette = np.zeros((0, 4), dtype=np.float32)
         self.width = 0
         self.height = 0
         self.format = TEXType.RGB8888
         self.mipmaps = []
+        self.first_mip = 0
         
         if filepath is not None:
-            self.read(filepath)
+            self.read(filepath, max_size)
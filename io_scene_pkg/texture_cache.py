@@ -0,0 +1,149 @@
+# ##### BEGIN LICENSE BLOCK #####
+#
+# This program is licensed under Creative Commons BY-NC-SA:
+# https://creativecommons.org/licenses/by-nc-sa/3.0/
+#
+# Created by Dummiesman, 2016-2020
+#
+# ##### END LICENSE BLOCK #####
+
+# on disk cache of decoded TEX files. entries are keyed by the TEX path, size, mtime
+# and the max texture size it was decoded at, and hold the RGBA bytes of the image.
+# this module doesn't use bpy, it's called from texture decoding threads
+
+import os, hashlib, threading
+import numpy as np
+
+from io_scene_pkg.tex_file import (TEXFile, TEXType, BYTE_TO_FLOAT)
+
+# bump when the decoders change, so old entries aren't used
+CACHE_VERSION = 2
+CACHE_EXTENSION = ".npz"
+
+hits = 0
+misses = 0
+counter_lock = threading.Lock()
+
+def count_lookup(hit):
+    global hits, misses
+    with counter_lock:
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+
+def get_counters():
+    """(hits, misses) since Blender started"""
+    return (hits, misses)
+
+def get_entry_path(directory, file_path, max_size):
+    """the cache file for a TEX file, or None if the TEX file doesn't exist"""
+    file_path = os.path.normcase(os.path.abspath(file_path))
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+
+    key = "%d|%s|%d|%d|%d" % (CACHE_VERSION, file_path, stat.st_size, stat.st_mtime_ns, max_size)
+    return os.path.join(directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + CACHE_EXTENSION)
+
+def remove_entry(entry_path):
+    try:
+        os.remove(entry_path)
+    except OSError:
+        pass # another thread got to it first
+
+def load(directory, file_path, max_size):
+    """get a (TEXFile, pixels) pair from the cache, the TEXFile only has its header set. None on a miss"""
+    entry_path = get_entry_path(directory, file_path, max_size)
+    if entry_path is None or not os.path.isfile(entry_path):
+        count_lookup(False)
+        return None
+
+    try:
+        with np.load(entry_path) as entry:
+            format, width, height, first_mip = (int(value) for value in entry["info"])
+            pixels = BYTE_TO_FLOAT[entry["pixels"]]
+    except Exception:
+        # a broken or truncated entry, remove it so it's written again after decoding
+        remove_entry(entry_path)
+        count_lookup(False)
+        return None
+
+    if len(pixels) != width * height * 4:
+        remove_entry(entry_path)
+        count_lookup(False)
+        return None
+
+    # entries are used least recently used first when trimming
+    try:
+        os.utime(entry_path)
+    except OSError:
+        pass
+
+    tf = TEXFile()
+    tf.format = TEXType(format)
+    tf.width = width
+    tf.height = height
+    tf.first_mip = first_mip
+
+    count_lookup(True)
+    return (tf, pixels)
+
+def store(directory, file_path, max_size, tf, pixels, max_cache_size):
+    """write decoded pixels to the cache, then trim it to max_cache_size bytes"""
+    entry_path = get_entry_path(directory, file_path, max_size)
+    if entry_path is None:
+        return
+
+    # pixels are byte values / 255, so they round trip exactly
+    pixel_bytes = np.rint(pixels * 255).astype(np.uint8)
+    info = np.array((int(tf.format), tf.width, tf.height, tf.first_mip), dtype=np.int64)
+
+    # write under a temporary name so other threads never see half an entry
+    temp_path = "%s.%d.tmp" % (entry_path, threading.get_ident())
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(temp_path, 'wb') as file:
+            np.savez(file, info=info, pixels=pixel_bytes)
+        os.replace(temp_path, entry_path)
+    except OSError as e:
+        print("Could not write texture cache entry for " + file_path + ": " + str(e))
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return
+
+    trim(directory, max_cache_size)
+
+def trim(directory, max_cache_size):
+    """remove the least recently used entries until the cache fits in max_cache_size bytes"""
+    entries = []
+    total_size = 0
+    try:
+        with os.scandir(directory) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.endswith(CACHE_EXTENSION):
+                    stat = dir_entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, dir_entry.path))
+                    total_size += stat.st_size
+    except OSError:
+        return
+
+    if total_size <= max_cache_size:
+        return
+
+    entries.sort()
+    for mtime, size, entry_path in entries:
+        if total_size <= max_cache_size:
+            break
+        try:
+            os.remove(entry_path)
+            total_size -= size
+        except OSError:
+            pass # another thread got to it first
+
+def clear(directory):
+    """remove every entry of the cache"""
+    trim(directory, 0)
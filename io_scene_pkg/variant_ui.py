@@ -9,8 +9,12 @@
 
 import bpy
 import textwrap 
+import os
 import os.path as path
+from concurrent.futures import ThreadPoolExecutor
 import io_scene_pkg.common_helpers as helper
+import io_scene_pkg.import_helper as import_helper
+import io_scene_pkg.angel_scenedata as angel_scenedata
 
 from bpy.types import (Panel,
                        Menu,
@@ -19,12 +23,48 @@ from bpy.types import (Panel,
                        UIList
                        )
                        
+from bpy.app.handlers import persistent
 from bpy.props import (IntProperty,
                        BoolProperty,
                        StringProperty,
                        CollectionProperty,
                        PointerProperty)
 
+# -------------------------------------------------------------------
+#   Helpers
+# -------------------------------------------------------------------
+def get_image_path_key(file_path):
+    return path.normcase(path.abspath(bpy.path.abspath(file_path)))
+    
+def get_images_by_path(file_paths):
+    """images that are already loaded from any of these paths"""
+    wanted = {get_image_path_key(file_path): file_path for file_path in file_paths}
+    images = {}
+    for image in bpy.data.images:
+        if len(image.filepath_raw) > 0:
+            file_path = wanted.get(get_image_path_key(image.filepath_raw))
+            if file_path is not None:
+                images.setdefault(file_path, image)
+    return images
+    
+def load_textures(file_paths):
+    """load images from paths, TEX files are decoded on worker threads"""
+    preferences = bpy.context.preferences
+    addon_prefs = preferences.addons[__package__].preferences
+    cache_settings = helper.get_texture_cache_settings(addon_prefs)
+    
+    tex_paths = [file_path for file_path in file_paths if file_path.lower().endswith(".tex") and path.isfile(file_path)]
+    images = {}
+    with ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as pool:
+        futures = {file_path: pool.submit(helper.read_tex_file, file_path, addon_prefs.max_texture_size, cache_settings) for file_path in tex_paths}
+        
+        # images are made on this thread as the decodes finish
+        for file_path in file_paths:
+            future = futures.get(file_path)
+            images[file_path] = helper.load_texture_from_path(file_path, tex_data=future.result() if future is not None else None)
+    return images
+    
+
 # -------------------------------------------------------------------
 #   Dialogs
 # -------------------------------------------------------------------
@@ -48,9 +88,13 @@ class CloneReplaceVariantDialog(Operator):
         # now edit this clone
         current_variant = angel.get_selected_variant()
         
+        # image nodes to point at a replacement, by replacement path
+        replacements = {}
         for vm in current_variant.materials:
             # get material
             material = vm.material
+            if material is None:
+                continue
             
             # replace material name
             material.name = material.name.replace(self.replace_str, self.with_str)
@@ -66,9 +110,18 @@ class CloneReplaceVariantDialog(Operator):
                         
                         # replace name
                         tail_name = tail_name.replace(self.replace_str, self.with_str)
-                        
-                        # re-combine and reapply
-                        node.image = helper.load_texture_from_path(path.join(head, tail_name + tail_ext))
+                        replacements.setdefault(path.join(head, tail_name + tail_ext), []).append(node)
+        
+        # each replacement is loaded once, reusing images that are loaded already
+        images = get_images_by_path(replacements.keys())
+        load_paths = [file_path for file_path in replacements if file_path not in images]
+        images.update(load_textures(load_paths))
+        
+        # re-apply
+        for file_path, nodes in replacements.items():
+            for node in nodes:
+                node.image = images[file_path]
+        invalidate_unused_filter()
 
         return {'FINISHED'}
  
@@ -98,6 +151,7 @@ class AddVariantOperator(Operator):
         variant = angel.variants.add()
         
         angel.selected_variant = len(angel.variants) - 1
+        invalidate_unused_filter()
         
         return {'FINISHED'}
         
@@ -132,6 +186,7 @@ class CloneVariantOperator(Operator):
             variant = angel.variants.add()
             variant.clone_from(current_variant)
             angel.selected_variant = len(angel.variants) - 1
+            invalidate_unused_filter()
         
         return {'FINISHED'}
 
@@ -188,6 +243,7 @@ class DeleteVariantOperator(Operator):
             if angel.selected_variant > 0:
                 angel.selected_variant -= 1
             angel.apply_to_scene()
+            invalidate_unused_filter()
         
         return {'FINISHED'}
         
@@ -221,8 +277,11 @@ class CloneMaterialFromVariantOperator(Operator):
         
         if variant.material_index < len(variant.materials):
             mtl_to_clone = variant.materials[variant.material_index].material
-            new_material = mtl_to_clone.copy()
-            new_material.cloned_from = None # orphan this, otherwise we break everything
+            if mtl_to_clone is not None:
+                new_material = mtl_to_clone.copy()
+                import_helper.clear_material_key(new_material)
+                new_material.cloned_from = None # orphan this, otherwise we break everything
+                invalidate_unused_filter()
             
 
         return {'FINISHED'}
@@ -245,6 +304,7 @@ class RemoveMaterialFromVariantOperator(Operator):
             variant.remove_material(mtl_to_remove)
             
             variant.apply_to_scene()
+            invalidate_unused_filter()
 
         return {'FINISHED'}
         
@@ -264,6 +324,7 @@ class AddMaterialToVariantOperator(Operator):
         variant.add_material(mtl_to_add)
         
         variant.apply_to_scene()
+        invalidate_unused_filter()
         
         return {'FINISHED'}
       
@@ -274,7 +335,16 @@ class AddMaterialToVariantOperator(Operator):
 class ANGEL_UL_materials(UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
         mat = item.material
-        if self.layout_type in {'DEFAULT', 'COMPACT'}:
+        if mat is None:
+            # variant isn't on the scene, it only has a shader
+            base_mat = item.get_base_material()
+            icon_value = layout.icon(base_mat) if base_mat is not None else 0
+            if self.layout_type in {'DEFAULT', 'COMPACT'}:
+                layout.label(text=item.get_display_name(), icon_value=icon_value)
+            elif self.layout_type in {'GRID'}:
+                layout.alignment = 'CENTER'
+                layout.label(text="", icon_value=icon_value)
+        elif self.layout_type in {'DEFAULT', 'COMPACT'}:
             layout.prop(mat, "name", text="", emboss=False, icon_value=layout.icon(mat))
         elif self.layout_type in {'GRID'}:
             layout.alignment = 'CENTER'
@@ -283,6 +353,36 @@ class ANGEL_UL_materials(UIList):
     def invoke(self, context, event):
         pass
         
+# flags of the last ANGEL_UL_materials_unused filter, redraws reuse them until something changes
+unused_filter_cache = {}
+
+# bumped when materials change in ways the material count doesn't show
+unused_filter_generation = 0
+
+def invalidate_unused_filter():
+    global unused_filter_generation
+    unused_filter_generation += 1
+    
+# owner of the material rename subscription, renames reorder bpy.data.materials
+material_name_owner = object()
+
+def subscribe_to_material_names():
+    bpy.msgbus.subscribe_rna(key=(bpy.types.Material, "name"),
+                             owner=material_name_owner,
+                             args=(),
+                             notify=invalidate_unused_filter)
+                             
+@persistent
+def clear_unused_filter_cache(dummy):
+    """undo and file loads can change materials without changing the list"""
+    unused_filter_cache.clear()
+    invalidate_unused_filter()
+    
+@persistent
+def resubscribe_to_material_names(dummy):
+    """file loads clear message bus subscriptions"""
+    subscribe_to_material_names()
+    
 class ANGEL_UL_materials_unused(UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
         mat = item
@@ -297,36 +397,37 @@ class ANGEL_UL_materials_unused(UIList):
         scene = context.scene
         angel = scene.angel
         
-        # get our variant materials
         variant = angel.get_selected_variant()
-        variant_materials = variant.materials
-        variant_materials_list = []
-        
-        # make a list of these, instead of a list of VariantMaterial
-        for vm in variant_materials:
-            variant_materials_list.append(vm.material)
-        
-        # Filter
         mats = getattr(data, propname)
         
+        # flags only change with the variant or the material list. this is checked on 
+        # every redraw, so it only uses counts, other changes bump the generation
+        signature = (variant.as_pointer() if variant is not None else None,
+                     len(variant.materials) if variant is not None else 0,
+                     len(mats),
+                     unused_filter_generation)
+        if unused_filter_cache.get("signature") == signature:
+            return unused_filter_cache["flags"], []
+            
+        # get our variant materials, and the base materials they replace
+        variant_materials = []
+        if variant is not None:
+            for vm in variant.materials:
+                variant_materials.extend(mat for mat in (vm.material, vm.get_base_material()) if mat is not None)
+        
         # Default return values.
-        flt_flags = []
         flt_neworder = []
-        
         flt_flags = [self.bitflag_filter_item] * len(mats)
         
-        # Filter by emptiness.
-        for idx, item in enumerate(mats):
-            mat = item
-            is_in_variant_cloned = False
-            for vm in variant_materials_list:
-                if vm.cloned_from == mat:
-                    is_in_variant_cloned = True
-                    break
-            if mat.cloned_from is not None or mat in variant_materials_list or is_in_variant_cloned:
+        # hide clones, materials in the variant, materials the variant has a clone of, and templates
+        hidden_materials = set(variant_materials) | angel_scenedata.variant_material_cache.get_materials()
+        
+        for idx, mat in enumerate(mats):
+            if mat.cloned_from is not None or mat in hidden_materials:
                 flt_flags[idx] &= ~self.bitflag_filter_item
 
-        
+        unused_filter_cache["signature"] = signature
+        unused_filter_cache["flags"] = flt_flags
         return flt_flags, flt_neworder
 
     def invoke(self, context, event):
@@ -439,12 +540,27 @@ classes = (
     ANGEL_UL_materials_unused
 )
 
+filter_cache_handlers = (bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post)
+
 def register():        
     from bpy.utils import register_class
     for cls in classes:
         register_class(cls)
+        
+    for handlers in filter_cache_handlers:
+        handlers.append(clear_unused_filter_cache)
+    bpy.app.handlers.load_post.append(resubscribe_to_material_names)
+    subscribe_to_material_names()
     
 def unregister():
+    for handlers in filter_cache_handlers:
+        if clear_unused_filter_cache in handlers:
+            handlers.remove(clear_unused_filter_cache)
+    if resubscribe_to_material_names in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(resubscribe_to_material_names)
+    bpy.msgbus.clear_by_owner(material_name_owner)
+    unused_filter_cache.clear()
+    
     from bpy.utils import unregister_class
     for cls in reversed(classes):
         unregister_class(cls)
@@ -0,0 +1,131 @@
+import io
+import struct
+
+import numpy as np
+import pytest
+
+import io_scene_pkg.binary_helper as bin
+from io_scene_pkg.fvf import FVF
+from io_scene_pkg.pkg_file import (PKGFile, GeometryData)
+from io_scene_pkg.shader_set import (ShaderSet, Shader)
+
+
+POSITIONS = np.array([(0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0)], dtype=np.float32)
+
+
+def geometry_payload(compact):
+    """one section with one strip of two triangles"""
+    fvf = FVF(("D3DFVF_XYZ", "D3DFVF_NORMAL", "D3DFVF_TEX1"))
+    count = struct.Struct('<H' if compact else '<L')
+
+    vertices = np.zeros(len(POSITIONS), dtype=bin.get_vertex_dtype(fvf, compact))
+    vertices['position'] = POSITIONS
+    if compact:
+        # triangle strip, the END flag is on the last index
+        indices = np.array([0, 1, 2, 3 | (1 << 15)], dtype='<u2')
+        prim_type = 4
+    else:
+        indices = np.array([0, 1, 2, 2, 1, 3], dtype='<u2')
+        prim_type = 3
+
+    data = io.BytesIO()
+    data.write(struct.pack('<5L', 1, len(POSITIONS), len(indices), 1, fvf.value))
+    data.write(struct.pack('<HH', 1, (1 << 8) if compact else 0))
+    data.write(count.pack(7)) # shader offset
+    data.write(count.pack(prim_type))
+    data.write(count.pack(len(POSITIONS)))
+    data.write(vertices.tobytes())
+    data.write(count.pack(len(indices)))
+    data.write(indices.tobytes())
+    return data.getvalue()
+
+
+def shaders_payload():
+    shader = Shader()
+    shader.name = "body"
+    data = io.BytesIO()
+    data.write(struct.pack('<LL', 1 + 128, 1))
+    shader.write(data, "byte")
+    return data.getvalue()
+
+
+def xrefs_payload():
+    data = io.BytesIO()
+    data.write(struct.pack('<L', 1))
+    data.write(struct.pack('<12f', 1, 0, 0, 0, 1, 0, 0, 0, 1, 5, 6, 7))
+    data.write(b'tree\x00max'.ljust(32, b'\x00'))
+    return data.getvalue()
+
+
+def make_pkg(version, compact):
+    files = [("BODY_H", geometry_payload(compact)),
+             ("shaders", shaders_payload()),
+             ("xrefs", xrefs_payload()),
+             ("offset", struct.pack('<fff', 1, 2, 3))]
+
+    data = io.BytesIO()
+    data.write(bytes("PKG" + str(version), "utf-8"))
+    for name, payload in files:
+        if version == 3:
+            bin.write_file(data, name, payload)
+        else:
+            # PKG2 has no FILE lengths
+            data.write(b'FILE')
+            bin.write_angel_string(data, name)
+            data.write(payload)
+    return data.getvalue(), files
+
+
+@pytest.mark.parametrize("version", [2, 3])
+@pytest.mark.parametrize("compact", [False, True])
+def test_table_of_contents(version, compact):
+    data, files = make_pkg(version, compact)
+    with PKGFile(data) as pkg:
+        assert pkg.version == version
+        assert [entry.name for entry in pkg.entries] == [name for name, payload in files]
+        assert [entry.type for entry in pkg.entries] == ["geometry", "shaders", "xrefs", "offset"]
+        assert [entry.length for entry in pkg.entries] == [len(payload) for name, payload in files]
+        assert pkg.get("shaders") is pkg.entries[1]
+        assert pkg.get("missing") is None
+
+
+@pytest.mark.parametrize("version", [2, 3])
+@pytest.mark.parametrize("compact", [False, True])
+def test_lazy_data(version, compact):
+    data, files = make_pkg(version, compact)
+    with PKGFile(data) as pkg:
+        geometry_entry = pkg.get("BODY_H")
+        assert geometry_entry._data is None
+        geometry = geometry_entry.data
+        assert isinstance(geometry, GeometryData)
+        assert geometry_entry.data is geometry
+        assert geometry.shader_offsets == [7]
+        assert np.array_equal(geometry.positions, POSITIONS)
+        assert geometry.num_triangles == 2
+        assert geometry.triangles.max() < geometry.num_vertices
+
+        shader_set = pkg.get("shaders").data
+        assert isinstance(shader_set, ShaderSet)
+        assert shader_set.type == "byte"
+        assert [[shader.name for shader in variant] for variant in shader_set.variants] == [["body"]]
+
+        xrefs = pkg.get("xrefs").data
+        assert len(xrefs) == 1
+        assert xrefs[0].name.startswith("tree\x00max")
+        assert tuple(xrefs[0].matrix[9:]) == (5, 6, 7)
+
+        assert tuple(pkg.get("offset").data) == (1, 2, 3)
+
+
+@pytest.mark.parametrize("version", [2, 3])
+@pytest.mark.parametrize("compact", [False, True])
+def test_truncated_file(version, compact):
+    data, files = make_pkg(version, compact)
+    for length in (len(data) - 1, len(data) // 2, 10):
+        with pytest.raises(Exception, match="truncated or corrupt"):
+            PKGFile(data[:length])
+
+
+def test_wrong_format():
+    with pytest.raises(Exception, match="wrong format"):
+        PKGFile(b'PKG4FILE')
@@ -0,0 +1,22 @@
+import pytest
+
+from io_scene_pkg.shader_set import Shader
+
+
+def test_shaders_are_not_hashable():
+    with pytest.raises(TypeError):
+        hash(Shader())
+
+
+def test_key_follows_edits():
+    shader = Shader()
+    other = Shader()
+    assert shader == other
+    assert shader.key() == other.key()
+
+    shaders = {shader.key(): shader}
+    shader.name = "body"
+    shader.diffuse_color[0] = 0.5
+    assert shader != other
+    assert shader.key() not in shaders
+    assert other.key() in shaders
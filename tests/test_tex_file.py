@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from io_scene_pkg.tex_file import (TEXFile, TEXType)
+
+
+def make_pixels(width, height, num_colors, seed=0):
+    """random image with a few opaque colors, so paletted formats keep them exactly"""
+    rng = np.random.RandomState(seed)
+    colors = np.ones((num_colors, 4), dtype=np.float32)
+    colors[:, :3] = rng.randint(0, 256, (num_colors, 3)) / 255
+    return colors[rng.randint(0, num_colors, (height, width))]
+
+
+def round_trip(tmp_path, pixels, format, generate_mips=True):
+    tex = TEXFile()
+    tex.encode(pixels, format, generate_mips)
+    file_path = str(tmp_path / "test.tex")
+    tex.write(file_path)
+    return tex, TEXFile(file_path)
+
+
+@pytest.mark.parametrize("format", [TEXType.P4, TEXType.PA4])
+@pytest.mark.parametrize("size", [(6, 6), (10, 3), (14, 7), (2, 1)])
+def test_4bit_round_trip_stops_before_odd_mips(tmp_path, format, size):
+    width, height = size
+    pixels = make_pixels(width, height, 8)
+    written, read = round_trip(tmp_path, pixels, format)
+
+    assert len(read.mipmaps) == len(written.mipmaps)
+    for mip in range(len(read.mipmaps)):
+        mip_width, mip_height = read.calculate_mip_size(mip)
+        assert (mip_width * mip_height) % 2 == 0
+        assert len(read.mipmaps[mip]) == read.calculate_mip_array_size(mip)
+        assert read.decode_mip(mip).shape == (mip_height, mip_width, 4)
+    assert np.array_equal(read.decode_mip(0), pixels)
+
+
+@pytest.mark.parametrize("format", [TEXType.P4, TEXType.PA4])
+@pytest.mark.parametrize("size", [(3, 3), (5, 7), (1, 1)])
+def test_4bit_odd_pixel_count_is_refused(format, size):
+    width, height = size
+    with pytest.raises(Exception):
+        TEXFile().encode(make_pixels(width, height, 4), format)
+
+
+@pytest.mark.parametrize("format", [TEXType.P8, TEXType.PA8, TEXType.P8A8, TEXType.RGB888, TEXType.RGB8888])
+@pytest.mark.parametrize("size", [(3, 3), (5, 7), (6, 6)])
+def test_odd_size_round_trip(tmp_path, format, size):
+    width, height = size
+    pixels = make_pixels(width, height, 32)
+    written, read = round_trip(tmp_path, pixels, format)
+
+    assert len(read.mipmaps) == len(written.mipmaps)
+    for mip in range(len(read.mipmaps)):
+        mip_width, mip_height = read.calculate_mip_size(mip)
+        assert read.decode_mip(mip).shape == (mip_height, mip_width, 4)
+    assert np.array_equal(read.decode_mip(0), pixels)
+
+
+def test_a1r5g5b5_channels_expand_separately(tmp_path):
+    # (alpha, red, green, blue) 5 bit values
+    values = [(1, 0x1F, 0, 0), (0, 0, 0x1F, 0), (1, 0, 0, 0x1F), (0, 0x10, 0x08, 0x01)]
+    color_shorts = np.array([(a << 15) | (r << 10) | (g << 5) | b for a, r, g, b in values], dtype='<u2')
+
+    tex = TEXFile()
+    tex.format = TEXType.A1R5G5B5
+    tex.width, tex.height = 2, 2
+    tex.mipmaps = [color_shorts.tobytes()]
+    decoded = np.rint(tex.decode_mip(0).reshape((-1, 4)) * 255).astype(np.int32)
+
+    expand = lambda c: (c << 3) | (c >> 2)
+    expected = [(expand(r), expand(g), expand(b), 255 if a else 0) for a, r, g, b in values]
+    assert decoded.tolist() == [list(color) for color in expected]
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+import io_scene_pkg.texture_cache as texture_cache
+from io_scene_pkg.tex_file import (TEXFile, TEXType)
+
+
+def write_tex(file_path):
+    pixels = np.ones((4, 4, 4), dtype=np.float32)
+    pixels[:, :, 0] = 0.5
+    tex = TEXFile()
+    tex.encode(pixels, TEXType.RGB8888, False)
+    tex.write(file_path)
+
+
+def test_round_trip(tmp_path):
+    tex_path = str(tmp_path / "test.tex")
+    cache_dir = str(tmp_path / "cache")
+    write_tex(tex_path)
+
+    tf = TEXFile(tex_path)
+    pixels = tf.get_pixels()
+    texture_cache.store(cache_dir, tex_path, 0, tf, pixels, 1 << 20)
+
+    cached_tf, cached_pixels = texture_cache.load(cache_dir, tex_path, 0)
+    assert (cached_tf.width, cached_tf.height, cached_tf.format) == (4, 4, TEXType.RGB8888)
+    assert np.array_equal(cached_pixels, pixels)
+
+
+def test_truncated_entry_is_a_miss_and_removed(tmp_path):
+    tex_path = str(tmp_path / "test.tex")
+    cache_dir = str(tmp_path / "cache")
+    write_tex(tex_path)
+
+    tf = TEXFile(tex_path)
+    texture_cache.store(cache_dir, tex_path, 0, tf, tf.get_pixels(), 1 << 20)
+    entry_path = texture_cache.get_entry_path(cache_dir, tex_path, 0)
+    with open(entry_path, 'rb') as file:
+        data = file.read()
+    with open(entry_path, 'wb') as file:
+        file.write(data[:len(data) // 2])
+
+    assert texture_cache.load(cache_dir, tex_path, 0) is None
+    assert not os.path.exists(entry_path)
+
+
+def test_clear(tmp_path):
+    tex_path = str(tmp_path / "test.tex")
+    cache_dir = str(tmp_path / "cache")
+    write_tex(tex_path)
+
+    tf = TEXFile(tex_path)
+    texture_cache.store(cache_dir, tex_path, 0, tf, tf.get_pixels(), 1 << 20)
+    texture_cache.clear(cache_dir)
+    assert os.listdir(cache_dir) == []
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from io_scene_pkg.pkg_file import convert_triangle_strips
+
+
+# the per-index expander convert_triangle_strips replaced, kept as the reference
+def check_degenerate(i1, i2, i3):
+    if i1 == i2 or i1 == i3 or i2 == i3:
+        return True
+    return False
+
+def triangle_strip_to_list(strip, clockwise):
+    """convert a strip of triangles into a list of triangles"""
+    triangle_list = []
+    for v in range(len(strip) - 2):
+        if clockwise:
+            triangle_list.extend([strip[v+1], strip[v], strip[v+2]])
+        else:
+            triangle_list.extend([strip[v], strip[v+1], strip[v+2]])
+
+        # make sure we aren't resetting the clockwise
+        # flag if we have a degenerate triangle
+        if not check_degenerate(strip[v], strip[v+1], strip[v+2]):
+            clockwise = not clockwise
+
+    return triangle_list
+
+def reference_convert_triangle_strips(tristrip_data):
+    """convert Midnight Club triangle strips into triangle list data"""
+    last_strip_cw = False
+    last_strip_indices = []
+    trilist_data = []
+    for us in tristrip_data:
+        # flags processing
+        FLAG_CW = ((us & (1 << 14)) != 0)
+        FLAG_END = ((us & (1 << 15)) != 0)
+        INDEX = us
+        if FLAG_CW:
+            INDEX &= ~(1 << 14)
+        if FLAG_END:
+            INDEX &= ~(1 << 15)
+
+        # cw flag is only set at the first index in the strip
+        if len(last_strip_indices) == 0:
+            last_strip_cw = FLAG_CW
+        last_strip_indices.append(INDEX)
+
+        # are we done with this strip?
+        if FLAG_END:
+            trilist_data.extend(triangle_strip_to_list(last_strip_indices, last_strip_cw))
+            last_strip_cw = False
+            last_strip_indices = []
+
+    return np.array(trilist_data, dtype=np.int32).reshape((-1, 3))
+
+
+def make_strip_buffer(rng, num_strips, unterminated_tail):
+    """random strips with CW/END flags. few distinct indices, so there are many degenerate triangles"""
+    data = []
+    for strip_num in range(num_strips + (1 if unterminated_tail else 0)):
+        strip = [int(index) for index in rng.randint(0, 6, rng.randint(1, 12))]
+        if rng.randint(2):
+            strip[0] |= 1 << 14
+        # CW bits on other indices are ignored
+        for i in range(1, len(strip)):
+            if rng.randint(8) == 0:
+                strip[i] |= 1 << 14
+        if strip_num < num_strips:
+            strip[-1] |= 1 << 15
+        data.extend(strip)
+    return np.array(data, dtype=np.uint16)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_reference(seed):
+    rng = np.random.RandomState(seed)
+    data = make_strip_buffer(rng, rng.randint(0, 8), rng.randint(2) == 1)
+
+    expected = reference_convert_triangle_strips(data.tolist())
+    result = convert_triangle_strips(data)
+    assert result.shape == expected.shape
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize("data", [[], [1, 2, 3], [1 | (1 << 15)], [1, 2 | (1 << 15)]])
+def test_no_triangles(data):
+    data = np.array(data, dtype=np.uint16)
+    assert convert_triangle_strips(data).shape == (0, 3)
+    assert len(reference_convert_triangle_strips(data.tolist())) == 0
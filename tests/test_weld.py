@@ -0,0 +1,70 @@
+import numpy as np
+
+from io_scene_pkg.array_helper import (unique_rows, weld_vertices, NORMAL_WELD_TOLERANCE)
+
+
+UP = (0, 0, 1)
+SIDE = (1, 0, 0)
+
+
+def weld(positions, normals, tolerance=0.0):
+    positions = np.array(positions, dtype=np.float32)
+    normals = np.array(normals, dtype=np.float32)
+    kept, remap = weld_vertices(positions, normals, tolerance)
+    return positions, normals, kept, remap
+
+
+def test_unique_rows_keeps_order_of_appearance():
+    rows = np.array([(3, 3), (1, 1), (3, 3), (2, 2), (1, 1)], dtype=np.int32)
+    kept, remap = unique_rows(rows)
+    assert kept.tolist() == [0, 1, 3]
+    assert remap.tolist() == [0, 1, 0, 2, 1]
+    assert np.array_equal(rows[kept][remap], rows)
+
+
+def test_exact_mode():
+    positions, normals, kept, remap = weld([(0, 0, 0), (1, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, -0.0), (1e-6, 0, 0)],
+                                           [UP, UP, UP, SIDE, UP, UP])
+    # same position with another normal, or a slightly different position, is kept
+    assert kept.tolist() == [0, 1, 3, 5]
+    assert remap.tolist() == [0, 1, 0, 2, 0, 3]
+
+
+def test_remap_reproduces_rows():
+    rng = np.random.RandomState(0)
+    positions = rng.randint(0, 4, (500, 3)).astype(np.float32)
+    normals = np.array([UP, SIDE], dtype=np.float32)[rng.randint(0, 2, 500)]
+    kept, remap = weld_vertices(positions, normals)
+
+    assert len(kept) == len(np.unique(np.hstack((positions, normals)), axis=0))
+    assert np.array_equal(positions[kept][remap], positions)
+    assert np.array_equal(normals[kept][remap], normals)
+    # every kept vertex maps to itself
+    assert np.array_equal(remap[kept], np.arange(len(kept)))
+
+
+def test_tolerance_mode_snaps_to_grid():
+    positions, normals, kept, remap = weld([(0.0, 0, 0), (0.009, 0, 0), (0.0101, 0, 0), (0.0049, 0, 0), (0.0051, 0, 0)],
+                                           [UP] * 5, 0.01)
+    # vertices in the same 0.01 cell merge, vertices either side of a cell edge don't
+    assert kept.tolist() == [0, 2]
+    assert remap.tolist() == [0, 0, 1, 0, 0]
+
+
+def test_tolerance_mode_keeps_normals_apart():
+    # a large positional tolerance must not merge vertices with different normals
+    normal_a = (0, 0, 1)
+    normal_b = (0, np.sin(0.1), np.cos(0.1))
+    positions, normals, kept, remap = weld([(0, 0, 0), (0.1, 0, 0), (0.2, 0, 0)],
+                                           [normal_a, normal_b, normal_a], 10.0)
+    assert kept.tolist() == [0, 1]
+    assert remap.tolist() == [0, 1, 0]
+
+
+def test_tolerance_mode_normals_use_their_own_grid():
+    # a tiny positional tolerance still merges normals within the same normal cell
+    offset = NORMAL_WELD_TOLERANCE / 4
+    positions, normals, kept, remap = weld([(0, 0, 0), (0, 0, 0)],
+                                           [(offset, 0, 1 - offset), (0, 0, 1 - offset)], 1e-6)
+    assert kept.tolist() == [0]
+    assert remap.tolist() == [0, 0]